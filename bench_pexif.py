@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+"""Microbenchmarks of pexif, the inner loop of pybatchgeotag: parsing, serialising and reading or setting the
+coordinates of a fixed corpus of generated EXIF blobs (little- and big-endian, Canon, Fuji and unknown maker notes,
+with and without thumbnail and GPS data).
+
+For each blob and operation, the number of objects allocated per operation is compared against a stored baseline,
+and the script exits with an error if any of them increased. Objects are the container objects (lists, tuples,
+instances...) allocated by an operation, net of those it freed, as counted by the garbage collector: unlike times,
+they do not depend on the machine or its load, so the baseline shipped in bench_pexif.json only holds them.
+
+With --times, the time per operation (median over several runs) is compared as well, against a baseline saved with
+--times on the same machine. A time regressed if it exceeds the baseline by more than the threshold, or by more than
+noise_factor times the spread of the runs (their median absolute deviation) if that is larger.
+
+Usage:
+
+python bench_pexif.py                                   # compare objects against bench_pexif.json
+python bench_pexif.py --save                            # store the current objects as the baseline
+python bench_pexif.py --times --save --baseline b.json  # store objects and times of this machine
+python bench_pexif.py --times --baseline b.json         # compare objects and times against them
+"""
+from __future__ import division, print_function
+import gc
+import json
+import os
+import sys
+import time
+from argparse import ArgumentParser
+from struct import pack
+
+import pexif
+from pexif import JpegFile, ExifSegment, APP1, ASCII, LONG, RATIONAL, SHORT, UNDEFINED
+
+default_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_pexif.json')
+# minimum duration of a run, over which the time per operation is averaged
+run_seconds = 0.05
+# calls of an operation before its objects are counted, after which the count no longer changes
+warmup_calls = 10
+# times regressed if they exceed the baseline by more than this many times the spread of the runs
+noise_factor = 3
+# CPU time of the process, which is less affected by other processes than wall time
+cpu_time = getattr(time, 'process_time', time.clock)
+
+sos = '\xff\xda' + pack('>H', 8) + '\x01\x01\x00\x00\x3f\x00'
+thumbnail = '\xff\xd8' + 'T' * 4000 + '\xff\xd9'
+
+
+def entry(e, tag, exif_type, values):
+    """Returns an IFD entry as a (tag, type, count, raw value) tuple"""
+    if exif_type == ASCII:
+        return tag, exif_type, len(values) + 1, values + '\0'
+    if exif_type == UNDEFINED:
+        return tag, exif_type, len(values), values
+    if exif_type == RATIONAL:
+        return tag, exif_type, len(values) // 2, pack(e + 'I' * len(values), *values)
+    return tag, exif_type, len(values), pack(e + {SHORT: 'H', LONG: 'I'}[exif_type] * len(values), *values)
+
+
+def ifd_size(entries):
+    return 2 + 12 * len(entries) + 4 + sum(len(raw) for _, _, _, raw in entries if len(raw) > 4)
+
+
+def build_ifd(e, entries, start, next_offset=0):
+    """Returns the bytes of an IFD starting at offset start, followed by its values that do not fit in an entry"""
+    data = pack(e + 'H', len(entries))
+    extra = ''
+    data_offset = start + 2 + 12 * len(entries) + 4
+    for tag, exif_type, count, raw in sorted(entries):
+        if len(raw) <= 4:
+            data += pack(e + 'HHI', tag, exif_type, count) + raw.ljust(4, '\0')
+        else:
+            data += pack(e + 'HHII', tag, exif_type, count, data_offset + len(extra))
+            extra += raw
+    return data + pack(e + 'I', next_offset) + extra
+
+
+def maker_note(make, start):
+    """Returns the maker note of a make, starting at offset start of the TIFF data"""
+    values = [entry('<', 0x100 + i, SHORT, range(1000 + i, 1020 + i)) for i in range(20)]
+    if make == 'Canon':  # an IFD with offsets from the start of the TIFF data, always little-endian
+        return build_ifd('<', values, start)
+    if make == 'FUJIFILM':  # a header, then an IFD with offsets from the start of the maker note
+        return 'FUJIFILM' + pack('<I', 12) + build_ifd('<', values, 12)
+    return 'UNKNOWN\0' + ''.join(raw for _, _, _, raw in values)  # kept as raw bytes by pexif
+
+
+def exif_jpeg(e='<', make=None, gps=False, thumb=False):
+    """Returns a small JPEG file with an EXIF segment of the given byte order, maker note, and GPS and thumbnail IFDs"""
+    ifd0 = [entry(e, 0x110, ASCII, 'Model 1'), entry(e, 0x112, SHORT, [1]), entry(e, 0x8769, LONG, [0])]
+    if make is not None:
+        ifd0.append(entry(e, 0x10f, ASCII, make))
+    if gps:
+        ifd0.append(entry(e, 0x8825, LONG, [0]))
+    exif = [entry(e, 0x9003, ASCII, '2016:03:27 07:05:00'), entry(e, 0x9000, UNDEFINED, '0230'),
+            entry(e, 0xa002, LONG, [4000]), entry(e, 0xa003, LONG, [3000])]
+    if make is not None:  # sized for now, the maker note is the last value of the EXIF IFD
+        exif.append(entry(e, 0x927c, UNDEFINED, maker_note(make, 0)))
+    gps_ifd = [entry(e, 0x0, UNDEFINED, '\x02\x02\x00\x00'), entry(e, 0x1, ASCII, 'N'),
+               entry(e, 0x2, RATIONAL, [47, 1, 22, 1, 1234, 100]), entry(e, 0x3, ASCII, 'E'),
+               entry(e, 0x4, RATIONAL, [8, 1, 32, 1, 5678, 100])]
+    ifd1 = [entry(e, 0x201, LONG, [0]), entry(e, 0x202, LONG, [len(thumbnail)])]
+
+    # IFD0, EXIF IFD, GPS IFD, IFD1 and the thumbnail follow each other
+    exif_offset = 8 + ifd_size(ifd0)
+    gps_offset = exif_offset + ifd_size(exif)
+    ifd1_offset = gps_offset + (ifd_size(gps_ifd) if gps else 0)
+    thumb_offset = ifd1_offset + ifd_size(ifd1)
+
+    def set_value(entries, tag, exif_type, values):
+        return [x if x[0] != tag else entry(e, tag, exif_type, values) for x in entries]
+    ifd0 = set_value(set_value(ifd0, 0x8769, LONG, [exif_offset]), 0x8825, LONG, [gps_offset])
+    ifd1 = set_value(ifd1, 0x201, LONG, [thumb_offset])
+    if make is not None:
+        note_offset = gps_offset - len(maker_note(make, 0))
+        exif = set_value(exif, 0x927c, UNDEFINED, maker_note(make, note_offset))
+
+    tiff = ('II' if e == '<' else 'MM') + pack(e + 'HI', 42, 8)
+    tiff += build_ifd(e, ifd0, 8, ifd1_offset if thumb else 0) + build_ifd(e, exif, exif_offset)
+    if gps:
+        tiff += build_ifd(e, gps_ifd, gps_offset)
+    if thumb:
+        tiff += build_ifd(e, ifd1, ifd1_offset) + thumbnail
+    app1 = 'Exif\0\0' + tiff
+    return pexif.SOI_MARKER + '\xff\xe1' + pack('>H', len(app1) + 2) + app1 + sos + '\x12\x34' * 1000 + \
+        pexif.EOI_MARKER
+
+
+corpus = [
+    ('le', dict(e='<')),
+    ('be', dict(e='>')),
+    ('le-gps', dict(e='<', gps=True)),
+    ('be-gps', dict(e='>', gps=True)),
+    ('le-thumb-gps', dict(e='<', gps=True, thumb=True)),
+    ('be-thumb', dict(e='>', thumb=True)),
+    ('canon-gps', dict(e='<', make='Canon', gps=True)),
+    ('canon-thumb', dict(e='<', make='Canon', thumb=True)),
+    ('fuji-gps', dict(e='<', make='FUJIFILM', gps=True)),
+    ('unknown-maker', dict(e='>', make='Unknown', gps=True)),
+]
+
+
+def operations(jpeg):
+    """Returns the (name, function) operations benchmarked on a JPEG file"""
+    app1 = jpeg[6:6 + int(jpeg[4:6].encode('hex'), 16) - 2]
+    segment = ExifSegment(APP1, None, app1, 'rw')
+    jf = JpegFile.fromString(jpeg)
+    tagged = JpegFile.fromString(jpeg)
+    tagged.set_geo(46.5, 7.25)
+    ops = [('JpegFile.fromString', lambda: JpegFile.fromString(jpeg)),
+           ('ExifSegment.parse_data', lambda: ExifSegment(APP1, None, app1, 'rw')),
+           ('IfdData.getdata', segment.encode),
+           ('JpegFile.set_geo', lambda: jf.set_geo(46.5, 7.25)),
+           ('JpegFile.writeString', tagged.writeString)]
+    if jf.exif.primary['GPSIFD'] is not None:
+        ops.append(('JpegFile.get_geo', jf.get_geo))
+    return ops
+
+
+def calibrate(fn):
+    """Returns how many times fn must be called for a run to last at least run_seconds"""
+    number = 1
+    while True:
+        start = cpu_time()
+        for _ in range(number):
+            fn()
+        if cpu_time() - start >= run_seconds:
+            return number
+        number *= 2
+
+
+def time_run(fn, number):
+    """Returns the time per call of fn in ns, over number calls"""
+    start = cpu_time()
+    for _ in range(number):
+        fn()
+    return (cpu_time() - start) / number * 1e9
+
+
+def objects_per_op(fn):
+    """Returns the number of container objects allocated by fn, net of those it freed, as counted by the garbage
+    collector"""
+    for _ in range(warmup_calls):  # warm up caches, and the state of the files set_geo modifies
+        fn()
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        result = fn()
+        after = gc.get_count()[0]
+    finally:
+        gc.enable()
+    del result
+    return after - before
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+
+def run(repeat=0):
+    """Runs the benchmarks, returning {'blob/operation': {'objects': ...}}, and if repeat is not 0 the median time of
+    repeat runs and their spread (median absolute deviation, relative to the median) as 'ns' and 'spread'. The runs of
+    all the benchmarks are interleaved, so that a transient slowdown of the machine affects one run of several
+    benchmarks rather than all the runs of one."""
+    benchmarks = []
+    for name, params in corpus:
+        for op, fn in operations(exif_jpeg(**params)):
+            benchmarks.append(('%s/%s' % (name, op), fn, calibrate(fn) if repeat else 0))
+    results = dict((key, {'objects': objects_per_op(fn)}) for key, fn, _ in benchmarks)
+    if not repeat:
+        return results
+    times = dict((key, []) for key, _, _ in benchmarks)
+    for _ in range(repeat):
+        for key, fn, number in benchmarks:
+            times[key].append(time_run(fn, number))
+    for key, samples in times.items():
+        ns = median(samples)
+        results[key]['ns'] = ns
+        results[key]['spread'] = median([abs(t - ns) for t in samples]) / ns
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Prints the results next to the baseline, and returns the names of the results that regressed: that allocate
+    more objects than the baseline, or if both have times, that are slower by more than threshold (a fraction) and
+    noise_factor times their spread"""
+    regressions = []
+    for key in sorted(results):
+        result = results[key]
+        base = baseline.get(key)
+        line = '%-42s %6d objects/op' % (key, result['objects'])
+        if base is None:
+            if 'ns' in result:
+                line += ' %10.0f ns/op +/-%4.1f%%' % (result['ns'], 100 * result['spread'])
+            print(line + '    (no baseline)')
+            continue
+        regressed = result['objects'] > base['objects']
+        line += ' %+5d' % (result['objects'] - base['objects'])
+        if 'ns' in result and 'ns' in base:
+            change = result['ns'] / base['ns'] - 1
+            tolerance = max(threshold, noise_factor * (result['spread'] + base.get('spread', 0)))
+            regressed = regressed or change > tolerance
+            line += ' %10.0f ns/op %+7.1f%% (tolerance %4.1f%%)' % (result['ns'], 100 * change, 100 * tolerance)
+        print(line + ('  REGRESSION' if regressed else ''))
+        if regressed:
+            regressions.append(key)
+    return regressions
+
+
+def main(argv):
+    arg_parser = ArgumentParser(description='Microbenchmarks of pexif, compared against a stored baseline')
+    arg_parser.add_argument('--baseline', default=default_baseline,
+                            help='Baseline file (default %(default)s)')
+    arg_parser.add_argument('--times', action='store_true',
+                            help='Time the operations too, and compare or save their times (only meaningful against a '
+                                 'baseline saved on the same machine)')
+    arg_parser.add_argument('--threshold', type=float, default=0.2,
+                            help='Relative slowdown above which a time regressed, unless the runs are noisier than that '
+                                 '(default 0.2, i.e. 20%%)')
+    arg_parser.add_argument('--repeat', type=int, default=15,
+                            help='Number of runs of each benchmark with --times, the median one is kept (default 15)')
+    arg_parser.add_argument('--save', action='store_true',
+                            help='Store the results as the new baseline instead of comparing them')
+    args = arg_parser.parse_args(argv[1:])
+
+    results = run(args.repeat if args.times else 0)
+    if args.save:
+        baseline = {}
+        for key, result in results.items():
+            baseline[key] = {'objects': result['objects']}
+            if 'ns' in result:
+                baseline[key].update(ns=round(result['ns']), spread=round(result['spread'], 4))
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=1, separators=(',', ': '), sort_keys=True)
+            f.write('\n')
+        compare(results, {}, args.threshold)
+        print('Saved baseline to %s' % args.baseline)
+        return 0
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except (IOError, OSError):
+        baseline = {}
+        print('No baseline found at %s, run with --save to store one' % args.baseline)
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print('%d of %d benchmarks regressed' % (len(regressions), len(results)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -95,11 +95,20 @@ except AttributeError:
 
 import StringIO
 import sys
+from array import array
 from struct import unpack, pack
 
 MAX_HEADER_SIZE = 64 * 1024
+
+# When writing a file, buffers smaller than this are joined together, larger
+# ones (i.e. the image data) are written as they are.
+WRITE_JOIN_SIZE = 64 * 1024
 DELIM = 0xff
 EOI = 0xd9
+SOS = 0xda
+# Start of frame markers, which give the dimensions of the image
+SOF_MARKERS = [0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7,
+               0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf]
 SOI_MARKER = chr(DELIM) + '\xd8'
 EOI_MARKER = chr(DELIM) + '\xd9'
 
@@ -126,6 +135,47 @@ def debug(*debug_string):
         print
 
 
+def join_small_buffers(buffers):
+    """Join runs of buffers smaller than WRITE_JOIN_SIZE, so that they
+    can be written at once. Larger buffers are returned as they are."""
+    joined = []
+    run = []
+    for buf in buffers:
+        if len(buf) < WRITE_JOIN_SIZE:
+            run.append(buf)
+            continue
+        if run:
+            joined.append("".join(run))
+            run = []
+        joined.append(buf)
+    if run:
+        joined.append("".join(run))
+    return joined
+
+
+def find_image_data(fd):
+    """Return the offset of the image data of the JPEG file object fd,
+    positioned at its start: that of its first start of scan segment, or of
+    its end of image marker if there is none. The segments before it are
+    skipped over without being parsed, the image data is not read."""
+    if fd.read(len(SOI_MARKER)) != SOI_MARKER:
+        raise JpegFile.InvalidFile("Error reading soi_marker")
+    offset = len(SOI_MARKER)
+    while 1:
+        head = fd.read(2)
+        if len(head) < 2 or ord(head[0]) != DELIM:
+            raise JpegFile.InvalidFile("Error, expecting delimiter at %d" %
+                                       offset)
+        if ord(head[1]) in (SOS, EOI):
+            return offset
+        head2 = fd.read(2)
+        if len(head2) < 2:
+            raise JpegFile.InvalidFile("Unexpected end of file at %d" %
+                                       offset)
+        offset += 2 + unpack(">H", head2)[0]
+        fd.seek(offset)
+
+
 class DefaultSegment:
     """DefaultSegment represents a particluar segment of a JPEG file.
     This class is instantiated by JpegFile when parsing Jpeg files
@@ -156,15 +206,18 @@ class DefaultSegment:
         pass
 
     def write(self, fd):
+        """Write out the segment on a given file object. JpegFile uses
+        get_buffers instead, so that the whole file is written at once."""
+        for buf in self.get_buffers():
+            fd.write(buf)
+
+    def get_buffers(self):
         """This method is called by JpegFile when writing out the file. It
-        must write out any data in the segment. This shouldn't in general be
-        overloaded by subclasses, they should instead override the get_data()
-        method."""
-        fd.write('\xff')
-        fd.write(pack('B', self.marker))
+        returns the list of strings making up the segment. This shouldn't in
+        general be overloaded by subclasses, they should instead override the
+        get_data() method."""
         data = self.get_data()
-        fd.write(pack('>H', len(data) + 2))
-        fd.write(data)
+        return [pack('>BBH', DELIM, self.marker, len(data) + 2), data]
 
     def get_data(self):
         """This method is called by write to generate the data for this segment.
@@ -211,10 +264,10 @@ class StartOfScanSegment(DefaultSegment):
         self.img_data = img_data[:-remaining]
         fd.seek(-remaining, 1)
 
-    def write(self, fd):
-        """Write segment data to a given file object"""
-        DefaultSegment.write(self, fd)
-        fd.write(self.img_data)
+    def get_buffers(self):
+        """The image data follows the segment, and is passed on without
+        being copied"""
+        return DefaultSegment.get_buffers(self) + [self.img_data]
 
     def dump(self, fd):
         """Dump as ascii readable data to a given file object"""
@@ -250,9 +303,38 @@ def exif_type_size(exif_type):
     return ExifType.lookup.get(exif_type).size
 
 
-class Rational:
+# Integer types are decoded into arrays rather than lists of Python ints.
+ARRAY_TYPECODES = {SHORT: 'H', LONG: 'I', SLONG: 'i'}
+NATIVE_ENDIAN = '<' if sys.byteorder == 'little' else '>'
+assert array('I').itemsize == 4 and array('i').itemsize == 4
+
+
+def unpack_array(e, exif_type, data):
+    """Decode the values of an integer entry into an array."""
+    values = array(ARRAY_TYPECODES[exif_type])
+    values.fromstring(data)
+    if e != NATIVE_ENDIAN:
+        values.byteswap()
+    return values
+
+
+def pack_array(e, exif_type, values):
+    """Encode the values (an array or a list) of an integer entry."""
+    typecode = ARRAY_TYPECODES[exif_type]
+    if not isinstance(values, array) or values.typecode != typecode:
+        values = array(typecode, values)
+    if e != NATIVE_ENDIAN:
+        values = array(typecode, values.tostring())
+        values.byteswap()
+    return values.tostring()
+
+
+class Rational(object):
     """A simple fraction class. Python 2.6 could use the inbuilt Fraction class."""
 
+    # EXIF blocks hold many of these, so keep them small
+    __slots__ = ('num', 'den')
+
     def __init__(self, num, den):
         """Create a number fraction num/den."""
         self.num = num
@@ -358,6 +440,7 @@ class IfdData(object):
                 return self.__delattr__(key)
             except AttributeError:
                 return None
+        self.dirty.add(key)
         for entry in self.entries:
             if key == entry[0]:
                 self.entries.remove(entry)
@@ -369,6 +452,7 @@ class IfdData(object):
         if len(self.tags[key]) < 3:
             msg = "Error: Tags aren't set up correctly. Tag: {:x}:{} should have tag type."
             raise Exception(msg.format(key, self.tags[key]))
+        self.dirty.add(key)
         if self.tags[key][2] == ASCII:
             if value is not None and not value.endswith('\0'):
                 value = value + '\0'
@@ -393,6 +477,12 @@ class IfdData(object):
         object.__setattr__(self, 'mode', mode)
         object.__setattr__(self, 'e', e)
         object.__setattr__(self, 'entries', [])
+        # Tags set or deleted since the IFD was parsed
+        object.__setattr__(self, 'dirty', set())
+        # Raw bytes of the values that can be changed in place (lists of
+        # rationals and arrays), to find out whether they were
+        object.__setattr__(self, 'parsed', {})
+        object.__setattr__(self, 'new', data is None)
 
         if data is None:
             return
@@ -404,31 +494,39 @@ class IfdData(object):
 
         for i in range(num_entries):
             start = (i * 12) + 2 + offset
-            debug("START: ", start)
             entry = unpack(e + "HHII", data[start:start+12])
             tag, exif_type, components, the_data = entry
 
-            debug("%s %s %s %s %s" % (hex(tag), exif_type,
-                                      exif_type_size(exif_type), components,
-                                      the_data))
+            # The debug messages are only formatted when needed, as this
+            # loop runs for every entry of every file.
+            if DEBUG:
+                debug("START: ", start)
+                debug("%s %s %s %s %s" % (hex(tag), exif_type,
+                                          exif_type_size(exif_type),
+                                          components, the_data))
             byte_size = exif_type_size(exif_type) * components
 
+            actual_data = None
             if tag in self.embedded_tags:
                 try:
                     actual_data = self.embedded_tags[tag][1](e, the_data, exif_file, self.mode, data)
                 except JpegFile.SkipTag as exc:
                     # If the tag couldn't be parsed, and raised 'SkipTag'
-                    # then we just continue.
-                    continue
-            else:
+                    # then it is kept as raw bytes, so that it is written
+                    # back as it was.
+                    pass
+            if actual_data is None:
                 if byte_size > 4:
-                    debug(" ...offset %s" % the_data)
+                    if DEBUG:
+                        debug(" ...offset %s" % the_data)
                     the_data = data[the_data:the_data+byte_size]
                 else:
                     the_data = data[start+8:start+8+byte_size]
 
                 if exif_type == BYTE or exif_type == UNDEFINED:
-                    actual_data = list(the_data)
+                    # Kept as a string, which behaves like the list of
+                    # characters it used to be.
+                    actual_data = the_data
                 elif exif_type == ASCII:
                     if the_data[-1] != '\0':
                         actual_data = the_data + '\0'
@@ -439,48 +537,77 @@ class IfdData(object):
                         # %s [%s]" % (self.tags.get(tag, (hex(tag), 0))[0],
                         # the_data, map(ord, the_data))
                     actual_data = the_data
-                elif exif_type == SHORT:
-                    actual_data = list(unpack(e + ("H" * components), the_data))
-                elif exif_type == LONG:
-                    actual_data = list(unpack(e + ("I" * components), the_data))
-                elif exif_type == SLONG:
-                    actual_data = list(unpack(e + ("i" * components), the_data))
+                elif exif_type in ARRAY_TYPECODES:
+                    actual_data = unpack_array(e, exif_type, the_data)
+                    self.parsed[tag] = the_data
                 elif exif_type == RATIONAL or exif_type == SRATIONAL:
-                    t = 'II' if exif_type == RATIONAL else 'ii'
-                    actual_data = []
-                    for i in range(components):
-                        actual_data.append(Rational(*unpack(e + t,
-                                                            the_data[i*8:
-                                                                     i*8+8])))
+                    t = 'I' if exif_type == RATIONAL else 'i'
+                    values = unpack(e + t * (2 * components), the_data)
+                    actual_data = [Rational(values[j], values[j + 1])
+                                   for j in range(0, 2 * components, 2)]
+                    self.parsed[tag] = the_data
                 else:
                     raise "Can't handle this"
 
-                if (byte_size > 4):
+                if DEBUG and byte_size > 4:
                     debug("%s" % actual_data)
 
                 self.special_handler(tag, actual_data)
             entry = (tag, exif_type, actual_data)
             self.entries.append(entry)
 
-            debug("%-40s %-10s %6d %s" % (self.tags.get(tag, (hex(tag), 0))[0],
-                                          ExifType.lookup[exif_type],
-                                          components, actual_data))
+            if DEBUG:
+                debug("%-40s %-10s %6d %s" % (self.tags.get(tag, (hex(tag), 0))[0],
+                                              ExifType.lookup[exif_type],
+                                              components, actual_data))
         self.ifd_handler(data)
 
     def isifd(self, other):
         """Return true if other is an IFD"""
         return issubclass(other.__class__, IfdData)
 
+    def changed(self):
+        """Return true if the IFD was created or modified since it was
+        parsed. IFDs embedded in it are not taken into account."""
+        return self.new or bool(self.dirty) or self.changed_in_place()
+
+    def changed_in_place(self):
+        """Return true if a list or array value parsed from the data was
+        modified in place, e.g. one of its elements set, rather than set
+        again through the IFD."""
+        for tag, exif_type, the_data in self.entries:
+            raw = self.parsed.get(tag)
+            if raw is None or tag in self.dirty:
+                continue
+            if exif_type in ARRAY_TYPECODES:
+                packed = pack_array(self.e, exif_type, the_data)
+            else:
+                t = 'II' if exif_type == RATIONAL else 'ii'
+                packed = "".join([pack(self.e + t, *value.as_tuple())
+                                  for value in the_data])
+            if packed != raw:
+                return True
+        return False
+
+    def walk(self):
+        """Yield the IFD and all the IFDs embedded in it"""
+        yield self
+        for tag, exif_type, the_data in self.entries:
+            if self.isifd(the_data):
+                for ifd in the_data.walk():
+                    yield ifd
+
     def getdata(self, e, offset, last=0):
         data_offset = offset+2+len(self.entries)*12+4
         output_data = ""
 
         out_entries = []
 
-        # Add any specifc data for the particular type
+        # Add any specifc data for the particular type. This may be a
+        # buffer, which is copied only here.
         extra_data = self.extra_ifd_data(data_offset)
         data_offset += len(extra_data)
-        output_data += extra_data
+        output_data += extra_data[:]
 
         for tag, exif_type, the_data in self.entries:
             magic_type = exif_type
@@ -509,12 +636,8 @@ class IfdData(object):
                 actual_data = "".join(the_data)
             elif exif_type == ASCII:
                 actual_data = the_data
-            elif exif_type == SHORT:
-                actual_data = pack(e + ("H" * components), *the_data)
-            elif exif_type == LONG:
-                actual_data = pack(e + ("I" * components), *the_data)
-            elif exif_type == SLONG:
-                actual_data = pack(e + ("i" * components), *the_data)
+            elif exif_type in ARRAY_TYPECODES:
+                actual_data = pack_array(e, exif_type, the_data)
             elif exif_type == RATIONAL or exif_type == SRATIONAL:
                 t = 'II' if exif_type == RATIONAL else 'ii'
                 actual_data = ""
@@ -640,7 +763,7 @@ def ifd_maker_note(e, offset, exif_file, mode, data):
         e = "<"
         # and the data is referenced from the start the Ifd data, not the
         # TIFF file.
-        ifd_data = data[offset:]
+        ifd_data = buffer(data, offset)
         return FujiIFD(e, ifd_offset, exif_file, mode, ifd_data)
     else:
         if unknown_maker_note_as_error:
@@ -827,11 +950,20 @@ class IfdThumbnail(IfdTIFF):
         if size is None or offset is None:
             raise JpegFile.InvalidFile("Thumbnail doesn't have an offset "
                                        "and/or size")
-        object.__setattr__(self, 'jpeg_data', data[offset:offset+size])
-        if len(self.jpeg_data) != size:
+        if offset + size > len(data):
             raise JpegFile.InvalidFile("Not enough data for JPEG thumbnail."
                                        "Wanted: %d got %d" %
-                                       (size, len(self.jpeg_data)))
+                                       (size, max(len(data) - offset, 0)))
+        # Keep a reference into the TIFF data rather than a copy, the
+        # thumbnail is rarely looked at.
+        object.__setattr__(self, 'jpeg_buffer', buffer(data, offset, size))
+
+    def _get_jpeg_data(self):
+        """Return the JPEG data of the thumbnail. It is only copied out of
+        the EXIF segment when accessed."""
+        return str(self.jpeg_buffer)
+
+    jpeg_data = property(_get_jpeg_data)
 
     def extra_ifd_data(self, offset):
         for i in range(len(self.entries)):
@@ -840,7 +972,7 @@ class IfdThumbnail(IfdTIFF):
                 # Print found field and updating
                 new_entry = (entry[0], entry[1], [offset])
                 self.entries[i] = new_entry
-        return self.jpeg_data
+        return self.jpeg_buffer
 
 
 class ExifSegment(DefaultSegment):
@@ -867,7 +999,8 @@ class ExifSegment(DefaultSegment):
             raise self.InvalidSegment("Bad Exif Marker. Got <%s>, "
                                       "expecting <Exif>" % exif)
 
-        tiff_data = data[TIFF_OFFSET:]
+        # The IFDs are parsed from a buffer rather than a copy of the data.
+        tiff_data = buffer(data, TIFF_OFFSET)
         data = None  # Don't need or want data for now on.
 
         self.tiff_endian = tiff_data[:2]
@@ -886,6 +1019,8 @@ class ExifSegment(DefaultSegment):
             raise JpegFile.InvalidFile("Bad TIFF tag. Got <%x>, expecting "
                                        "<%x>" % (tiff_tag, TIFF_TAG))
 
+        self.tiff_offset = tiff_offset
+
         # Ok, the header parse out OK. Now we parse the IFDs contained in
         # the APP1 header.
 
@@ -908,6 +1043,7 @@ class ExifSegment(DefaultSegment):
 
             # Get next offset
             offset = unpack(self.e + "I", tiff_data[start:start+4])[0]
+        self.parsed_ifds = list(self.ifds)
 
     def dump(self, fd):
         print >> fd, " Section: [ EXIF] Size: %6d" % (len(self.data))
@@ -915,6 +1051,76 @@ class ExifSegment(DefaultSegment):
             ifd.dump(fd)
 
     def get_data(self):
+        """Return the data of the segment. If no IFD was changed, this is
+        the data it was parsed from. If only the GPS IFD was, the original
+        data is kept and the GPS IFD is appended to it (see patch_gps).
+        Otherwise all the IFDs are encoded again."""
+        if self.data is not None and self.ifds == self.parsed_ifds:
+            changed = [ifd for top in self.ifds
+                       for ifd in top.walk() if ifd.changed()]
+            if not changed:
+                return self.data
+            data = self.patch_gps(changed)
+            if data is not None:
+                return data
+        return self.encode()
+
+    def patch_gps(self, changed):
+        """Return the original data of the segment with the GPS IFD
+        appended to it, and the pointer to it updated. If the pointer is
+        added or removed, a new IFD0 table is appended as well, made of
+        the original raw entries, and the TIFF header points to it. The
+        other IFDs and maker notes stay at their offsets, so the offsets
+        they contain remain valid. Return None if other IFDs were changed,
+        or if the segment would become too large."""
+        primary = self.ifds[0]
+        gps = primary[0x8825]
+        for ifd in changed:
+            if ifd is primary:
+                if ifd.new or not ifd.dirty <= set([0x8825]) or \
+                        ifd.changed_in_place():
+                    return None
+            elif ifd is not gps:
+                return None
+
+        e = self.e
+        tiff = self.data[TIFF_OFFSET:]
+        count = unpack(e + 'H', tiff[self.tiff_offset:self.tiff_offset+2])[0]
+        start = self.tiff_offset + 2
+        entries = [tiff[i:i+12] for i in range(start, start + 12*count, 12)]
+        next_pointer = tiff[start + 12*count:start + 12*count + 4]
+        tags = [unpack(e + 'H', entry[:2])[0] for entry in entries]
+
+        # IFDs start on a word boundary
+        end = len(tiff) + len(tiff) % 2
+        appended = '\0' * (len(tiff) % 2)
+        if gps is not None:
+            gps_data, next_offset = gps.getdata(e, end, 1)
+            gps_entry = pack(e + 'HHII', 0x8825, LONG, 1, end)
+            appended += gps_data + '\0' * (next_offset % 2)
+            end = next_offset + next_offset % 2
+
+        if gps is not None and 0x8825 in tags:
+            # Only the value of the pointer changes
+            pointer = start + 12*tags.index(0x8825) + 8
+            tiff = tiff[:pointer] + gps_entry[8:] + tiff[pointer+4:]
+        else:
+            entries = [entry for tag, entry in zip(tags, entries)
+                       if tag != 0x8825]
+            if gps is not None:
+                entries.append(gps_entry)
+                entries.sort(key=lambda entry: unpack(e + 'H', entry[:2])[0])
+            appended += pack(e + 'H', len(entries)) + "".join(entries) + \
+                next_pointer
+            tiff = tiff[:4] + pack(e + 'I', end) + tiff[8:]
+
+        data = self.data[:TIFF_OFFSET] + tiff + appended
+        if len(data) + 2 > 0xffff:
+            return None
+        return data
+
+    def encode(self):
+        """Encode all the IFDs of the segment."""
         ifds_data = ""
         next_offset = 8
         for ifd in self.ifds:
@@ -996,20 +1202,23 @@ class JpegFile:
     writeFile, writeString or writeFd. To get an ASCII dump of the data in a file
     use the dump method."""
 
-    def fromFile(filename, mode="rw"):
+    def fromFile(filename, mode="rw", headers_only=False):
         """Return a new JpegFile object from a given filename."""
         with open(filename, "rb") as f:
-            return JpegFile(f, filename=filename, mode=mode)
+            return JpegFile(f, filename=filename, mode=mode,
+                            headers_only=headers_only)
     fromFile = staticmethod(fromFile)
 
-    def fromString(str, mode="rw"):
+    def fromString(str, mode="rw", headers_only=False):
         """Return a new JpegFile object taking data from a string."""
-        return JpegFile(StringIO.StringIO(str), "from buffer", mode=mode)
+        return JpegFile(StringIO.StringIO(str), "from buffer", mode=mode,
+                        headers_only=headers_only)
     fromString = staticmethod(fromString)
 
-    def fromFd(fd, mode="rw"):
+    def fromFd(fd, mode="rw", headers_only=False):
         """Return a new JpegFile object taking data from a file object."""
-        return JpegFile(fd, "fd <%d>" % fd.fileno(), mode=mode)
+        return JpegFile(fd, "fd <%d>" % fd.fileno(), mode=mode,
+                        headers_only=headers_only)
     fromFd = staticmethod(fromFd)
 
     class SkipTag(Exception):
@@ -1024,12 +1233,15 @@ class JpegFile:
         """This exception is raised if a section is unable to be found."""
         pass
 
-    def __init__(self, input, filename=None, mode="rw"):
+    def __init__(self, input, filename=None, mode="rw", headers_only=False):
         """JpegFile Constructor. input is a file object, and filename
         is a string used to name the file. (filename is used only for
         display functions).  You shouldn't use this function directly,
         but rather call one of the static methods fromFile, fromString
-        or fromFd."""
+        or fromFd. With headers_only, reading stops at the start of the
+        image data, so that the metadata of large files can be read
+        quickly. The file can then only be opened read-only."""
+        assert mode == "ro" or not headers_only
         self.filename = filename
         self.mode = mode
         # input is the file descriptor
@@ -1052,10 +1264,12 @@ class JpegFile:
             if mark == EOI:
                 # Hit end of image marker, game-over!
                 break
+            if mark == SOS and headers_only:
+                break
             head2 = input.read(2)
             size = unpack(">H", head2)[0]
             data = input.read(size-2)
-            possible_segment_classes = jpeg_markers[mark][1] + [DefaultSegment]
+            possible_segment_classes = jpeg_markers.get(mark, (None, []))[1] + [DefaultSegment]
             # Try and find a valid segment class to handle
             # this data
             for segment_class in possible_segment_classes:
@@ -1078,17 +1292,40 @@ class JpegFile:
         self.writeFd(f)
         return f.getvalue()
 
-    def writeFile(self, filename):
-        """Write the JpegFile out to a file named filename."""
-        output = open(filename, "wb")
-        self.writeFd(output)
-
-    def writeFd(self, output):
-        """Write the JpegFile out on the file object output."""
-        output.write(SOI_MARKER)
+    def writeFile(self, filename, buffers=None):
+        """Write the JpegFile out to a file named filename. buffers are
+        those returned by gather_buffers, if they were gathered already
+        (e.g. to check the image data before overwriting a file)."""
+        with open(filename, "wb") as output:
+            self.writeFd(output, buffers)
+
+    def writeFd(self, output, buffers=None):
+        """Write the JpegFile out on the file object output. The segments are
+        gathered first, unless buffers are given (see writeFile), and written
+        with one write per large buffer (see join_small_buffers)."""
+        if buffers is None:
+            buffers = self.gather_buffers()[0]
+        for buf in join_small_buffers(buffers):
+            output.write(buf)
+
+    def get_buffers(self):
+        """Return the list of strings making up the file, in order."""
+        return self.gather_buffers()[0]
+
+    def gather_buffers(self):
+        """Return the list of strings making up the file, in order, and the
+        index of the first one of the image data: that of the first start of
+        scan segment, or the end of image marker if there is none."""
+        buffers = [SOI_MARKER]
+        image_start = None
         for segment in self._segments:
-            segment.write(output)
-        output.write(EOI_MARKER)
+            if image_start is None and segment.marker == SOS:
+                image_start = len(buffers)
+            buffers.extend(segment.get_buffers())
+        if image_start is None:
+            image_start = len(buffers)
+        buffers.append(EOI_MARKER)
+        return buffers, image_start
 
     def dump(self, f=sys.stdout):
         """Write out ASCII representation of the file on a given file
@@ -1167,6 +1404,15 @@ class JpegFile:
         new_seg = [seg for seg in other._segments if seg.code == 'COM' or seg.code.startswith('APP')]
         self._segments = new_seg + self._segments
 
+    def get_dimensions(self):
+        """Return a tuple of (width, height) of the image, read from its
+        start of frame segment, or None if there is none."""
+        for segment in self._segments:
+            if segment.marker in SOF_MARKERS and len(segment.data) >= 5:
+                height, width = unpack(">HH", segment.data[1:5])
+                return width, height
+        return None
+
     def get_geo(self):
         """Return a tuple of (latitude, longitude)."""
         def convert(x):
@@ -1205,28 +1451,42 @@ class JpegFile:
 
     _parse = staticmethod(_parse)
 
+    def encode_geo(lat, lng):
+        """Return the GPS tag values (latitude reference, latitude,
+        longitude reference, longitude) encoding a given lat and lng. They
+        can be computed once and given to set_encoded_geo for several
+        files."""
+        sign, deg, min, sec = JpegFile._parse(lat)
+        lat_ref = "N"
+        if sign < 0:
+            lat_ref = "S"
+        latitude = [Rational(deg, 1),
+                    Rational(min, 1),
+                    Rational(sec, JpegFile.SEC_DEN)]
+
+        sign, deg, min, sec = JpegFile._parse(lng)
+        lng_ref = "E"
+        if sign < 0:
+            lng_ref = "W"
+        longitude = [Rational(deg, 1),
+                     Rational(min, 1),
+                     Rational(sec, JpegFile.SEC_DEN)]
+        return (lat_ref, latitude, lng_ref, longitude)
+
+    encode_geo = staticmethod(encode_geo)
+
     def set_geo(self, lat, lng):
         """Set the GeoLocation to a given lat and lng"""
+        self.set_encoded_geo(JpegFile.encode_geo(lat, lng))
+
+    def set_encoded_geo(self, encoded):
+        """Set the GeoLocation to values returned by encode_geo"""
         if self.mode != "rw":
             raise RWError
 
         gps = self.exif.primary.GPS
-
-        sign, deg, min, sec = JpegFile._parse(lat)
-        ref = "N"
-        if sign < 0:
-            ref = "S"
-
-        gps.GPSLatitudeRef = ref
-        gps.GPSLatitude = [Rational(deg, 1),
-                           Rational(min, 1),
-                           Rational(sec, JpegFile.SEC_DEN)]
-
-        sign, deg, min, sec = JpegFile._parse(lng)
-        ref = "E"
-        if sign < 0:
-            ref = "W"
-        gps.GPSLongitudeRef = ref
-        gps.GPSLongitude = [Rational(deg, 1),
-                            Rational(min, 1),
-                            Rational(sec, JpegFile.SEC_DEN)]
+        lat_ref, latitude, lng_ref, longitude = encoded
+        gps.GPSLatitudeRef = lat_ref
+        gps.GPSLatitude = latitude
+        gps.GPSLongitudeRef = lng_ref
+        gps.GPSLongitude = longitude
@@ -1,18 +1,82 @@
 #!/usr/bin/env python
 
 from __future__ import division
-from builtins import input
 import sys
 import os
+import csv
+import re
 import glob
+import heapq
+import json
+import hashlib
+import struct
+import time
+import threading
 import logging
+import multiprocessing
 import datetime
+import importlib
 import pytz
-import numpy as np
-import pandas as pd
 from argparse import ArgumentParser
-from pexif import JpegFile
+from array import array
+from bisect import bisect_right
+from collections import Counter, OrderedDict, deque, namedtuple
+from io import BytesIO
+from pexif import JpegFile, MAX_HEADER_SIZE, find_image_data
 from tzlocal import get_localzone
+try:
+    from __builtin__ import raw_input as input  # Python 2
+except ImportError:
+    pass
+try:
+    from Queue import Queue, Empty  # Python 2
+except ImportError:
+    from queue import Queue, Empty
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer  # Python 2
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+try:
+    import xml.etree.cElementTree as ET  # Python 2, where xml.etree.ElementTree is the pure Python parser
+except ImportError:
+    import xml.etree.ElementTree as ET
+try:
+    import ctypes
+except ImportError:  # only used for posix_fadvise with Python 2
+    ctypes = None
+try:
+    import fcntl
+except ImportError:  # not on Windows, where files can only be ordered by inode number
+    fcntl = None
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:  # watch mode falls back to polling the folder
+    INotify = None
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+# messages about each geotagged picture, on their own logger so that long runs can leave them out
+file_logger = logging.getLogger(__name__ + '.files')
+
+
+class LazyModule(object):
+    """Module imported on first use. numpy and pandas take most of the start-up time, and geotagging a few pictures
+    with a small coordinates file does not need them"""
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
 
 # we need to manually specify datetime formats because date is often weirdly written, like "2016:12:31"
 # this confuses automatic parsers such as python-dateutil's
@@ -21,46 +85,2267 @@ datetime_formats = ['%Y:%m:%d %H:%M:%S',
                     '%Y-%m-%d %H:%M:%S',
                     '%Y-%m-%d %H:%M:%S%Z',
                     '%Y/%m/%d %H:%M:%S',
-                    '%Y/%m/%d %H:%M:%S%Z']
+                    '%Y/%m/%d %H:%M:%S%Z',
+                    '%Y-%m-%dT%H:%M:%S']
+
+jpeg_extensions = ['jpg', 'JPG', 'jpeg', 'JPEG']
+# str and unicode on Python 2, str on Python 3
+string_types = (str, type(u''))
+
+location_array_re = re.compile(br'"locations"\s*:\s*\[')
+location_record_re = re.compile(br'[\[,]\s*\{')
+
+iso_datetime_re = re.compile(r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(\.\d+)?(Z|[+-]\d\d:?\d\d)?$')
+
+# tolerance (in degrees) below which coordinates are the same geotag: pexif stores seconds as sec/SEC_DEN, truncated,
+# so coordinates read back can be one step off the ones written, plus floating-point error; hence two steps
+geo_tolerance = 2.0 / (3600 * JpegFile.SEC_DEN)
+
+earth_radius_km = 6371.0
+
+# default size cap of the track cache in bytes, and version of its entries (to change whenever Track does)
+track_cache_size = 256 * 2**20
+track_cache_version = 1
+
+# FIEMAP ioctl of Linux, giving the physical extents of a file: struct fiemap header, then struct fiemap_extent
+fiemap_ioctl = 0xC020660B
+fiemap_header = struct.Struct('=QQIIII')  # start, length, flags, mapped extents, extent count, reserved
+fiemap_extent = struct.Struct('=QQQQQIIII')  # logical, physical, length, 2 reserved, flags, 3 reserved
+
+# coordinates files up to this total size (in bytes) are loaded without pandas in geotag mode, see ArrayTrack
+array_track_max_size = 2**20
+
+# number of pictures watch mode remembers, as geotagged by itself or as waiting for the track to reach their time
+watch_max_remembered = 100000
+# attempts of watch mode at loading the coordinates files while they are not being appended to, and delay between them
+watch_load_attempts = 5
+watch_load_delay = 0.2
 
+# number of threads reading the start of the files ahead of the parser, see prefetch_headers
+prefetch_threads = 4
+# advice of the readahead hints given by posix_fadvise (their values on Linux and the BSDs with Python 2)
+posix_fadv_willneed = getattr(os, 'POSIX_FADV_WILLNEED', 3)
+posix_fadv_dontneed = getattr(os, 'POSIX_FADV_DONTNEED', 4)
 
-def list_jpegs(folder='.', recursive=False):
-    file_extensions = ['jpg', 'JPG', 'jpeg', 'JPEG']
+# hash function of the image data of the pictures rewritten with --verify, and size of the chunks it is read in
+image_hash_name = 'sha1'
+image_hash_chunk_size = 2**20
+
+# number of pictures per batch of the inventory, i.e. per row group of a Parquet file
+inventory_batch_size = 4096
+inventory_columns = ['path', 'size', 'datetime', 'make', 'model', 'latitude', 'longitude', 'width', 'height']
+
+xmp_namespaces = {'x': 'adobe:ns:meta/',
+                  'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+                  'xmp': 'http://ns.adobe.com/xap/1.0/',
+                  'exif': 'http://ns.adobe.com/exif/1.0/'}
+for prefix, uri in xmp_namespaces.items():
+    ET.register_namespace(prefix, uri)
+# packet wrapper around XMP data, kept when a sidecar file is rewritten, and prefixes ElementTree generates itself
+xpacket_begin_re = re.compile(br'<\?xpacket begin=.*?\?>')
+xpacket_end_re = re.compile(br'<\?xpacket end=.*?\?>')
+generated_prefix_re = re.compile(r'ns\d+$')
+# the prefixes registered with ElementTree are global, so they are only changed and used by one writer at a time
+xmp_lock = threading.Lock()
+
+
+def list_jpegs(folder='.', recursive=False, shard=None):
+    """Returns the JPEG files of a folder. If shard is given as an (i, n) tuple, only the files of shard i out of n
+    are returned, see in_shard"""
     matched_files = []
-    for fe in file_extensions:
+    for fe in jpeg_extensions:
         if not recursive:
             matched_files.extend(glob.glob(os.path.join(folder, '*.%s' % fe)))
         else:
             for root, folders, files in os.walk(folder):
                 matched_files.extend(glob.glob(os.path.join(root, '*.%s' % fe)))
+    if shard is not None:
+        matched_files = [f for f in matched_files if in_shard(f, folder, shard)]
     return matched_files
 
 
+def iter_jpegs(folder='.', recursive=False, shard=None):
+    """Yields the JPEG files of a folder as they are found, like list_jpegs but without holding the whole list, so that
+    libraries of millions of files can be streamed"""
+    for root, folders, files in os.walk(folder):
+        for name in files:
+            if is_jpeg(name) and not name.startswith('.'):  # glob skips hidden files too
+                path = os.path.join(root, name)
+                if shard is None or in_shard(path, folder, shard):
+                    yield path
+        if not recursive:
+            break
+
+
+def iter_batches(iterable, size):
+    """Yields the items of an iterable in lists of up to size items"""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def parse_shard(s):
+    """Parses a shard given as "i/n" (1 <= i <= n) into an (i, n) tuple. Raises ValueError if it is invalid."""
+    try:
+        i, n = [int(x) for x in s.split('/')]
+    except ValueError:
+        raise ValueError('Shard should be given as i/n, got "%s"' % s)
+    if not 1 <= i <= n:
+        raise ValueError('Shard %d/%d does not exist' % (i, n))
+    return i, n
+
+
+def in_shard(path, folder, shard):
+    """Returns True if a file belongs to shard (i, n). Files are assigned to shards with a hash of their path
+    relative to folder, so that machines mounting the same folder at different places agree without coordination."""
+    i, n = shard
+    relpath = os.path.relpath(path, folder).replace(os.sep, '/')
+    if not isinstance(relpath, bytes):
+        relpath = relpath.encode('utf-8')
+    return int(hashlib.md5(relpath).hexdigest(), 16) % n == i - 1
+
+
+def parse_coordinates_row(row):
+    """Parses a row of a coordinates file into a (dt, accuracy, latitude, longitude) tuple, see read_coordinates"""
+    try:
+        dt = parse_iso_datetime(row[0])
+    except ValueError:  # any other format that pandas understands
+        dt = pd.Timestamp(row[0])
+        if dt.tzinfo is not None:
+            dt = dt.tz_convert('UTC').tz_localize(None)
+        dt = dt.to_pydatetime()
+    accuracy = float(row[3]) if len(row) > 3 and row[3] else float('inf')
+    return dt, accuracy, float(row[1]), float(row[2])
+
+
+def read_coordinates(filename, no_header=False):
+    """Generator over the rows of a coordinates file, as (dt, accuracy, latitude, longitude) tuples.
+    Timestamps are naive UTC, like the ones pandas parses from the file. The optional fourth column is the accuracy of
+    the location in metres; rows without one get an infinite accuracy so that they lose any tie.
+    Raises ValueError if the file is not sorted by time, since it could then not be merged."""
+    with open(filename) as f:
+        reader = csv.reader(f)
+        if not no_header:
+            next(reader, None)
+        last_dt = None
+        for row in reader:
+            if not row:
+                continue
+            dt, accuracy, lat, lng = parse_coordinates_row(row)
+            if last_dt is not None and dt < last_dt:
+                raise ValueError('%s is not sorted by time (%s comes after %s)' % (filename, dt, last_dt))
+            last_dt = dt
+            yield dt, accuracy, lat, lng
+
+
+def merge_coordinates(filenames, no_header=False):
+    """Merges several time-sorted coordinates files into a single time-sorted stream of (dt, latitude, longitude)
+    tuples. Only one row per file is held in memory at a time. When several files have a location for the same
+    timestamp, the most accurate one is kept."""
+    last_dt = None
+    for dt, accuracy, lat, lng in heapq.merge(*[read_coordinates(fn, no_header) for fn in filenames]):
+        if dt == last_dt:  # duplicate timestamp: rows are ordered by accuracy, so the best one came first
+            continue
+        last_dt = dt
+        yield dt, lat, lng
+
+
+def parse_exif_datetime(s):
+    """Parses an EXIF time stamp in one of the datetime_formats into a naive datetime. Returns None if it cannot be
+    parsed."""
+    for dtf in datetime_formats:
+        try:
+            return datetime.datetime.strptime(s, dtf)
+        except ValueError:
+            pass
+    return None
+
+
+def parse_iso_datetime(s):
+    """Parses an ISO 8601 time stamp as found in GPX files (e.g. "2016-03-27T05:00:27.380Z" or
+    "2016-03-27T07:00:27+02:00") or coordinates files (e.g. "2016-03-27 05:00:27.380000+00:00") into a naive UTC
+    datetime"""
+    m = iso_datetime_re.match(s.strip())
+    if m is None:
+        raise ValueError('Not an ISO 8601 time stamp: %s' % s)
+    microsecond = int((m.group(7)[1:] + '000000')[:6]) if m.group(7) else 0
+    dt = datetime.datetime(*([int(x) for x in m.group(1, 2, 3, 4, 5, 6)] + [microsecond]))
+    offset = m.group(8)
+    if offset and offset != 'Z':
+        sign = -1 if offset[0] == '-' else 1
+        dt -= sign * datetime.timedelta(hours=int(offset[1:3]), minutes=int(offset[-2:]))
+    return dt
+
+
+def read_gpx(filename):
+    """Generator over the track points of a GPX file, as (dt, latitude, longitude) tuples with naive UTC timestamps.
+    The file is parsed incrementally and every point is dropped from the tree once read, so memory use does not
+    depend on the size of the file. Points without a time stamp are ignored."""
+    stack = []
+    for event, elem in ET.iterparse(filename, events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            continue
+        stack.pop()
+        if elem.tag.rsplit('}', 1)[-1] != 'trkpt':
+            continue
+        for child in elem:
+            if child.tag.rsplit('}', 1)[-1] == 'time' and child.text:
+                yield parse_iso_datetime(child.text), float(elem.get('lat')), float(elem.get('lon'))
+                break
+        elem.clear()
+        if stack:
+            stack[-1].remove(elem)
+
+
+def nmea_degrees(value, hemisphere):
+    """Converts an NMEA (d)ddmm.mmmm coordinate and its hemisphere letter into signed decimal degrees"""
+    value = float(value)
+    degrees = int(value / 100)
+    degrees += (value - degrees * 100) / 60.0
+    return -degrees if hemisphere in ('S', 'W') else degrees
+
+
+def read_nmea(filename):
+    """Generator over the fixes of an NMEA 0183 log, as (dt, latitude, longitude) tuples with naive UTC timestamps.
+    Only RMC sentences (from any talker, e.g. $GPRMC or $GNRMC) are used, since they are the only ones carrying the
+    date. Sentences with a bad checksum or a void fix are ignored."""
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if not line.startswith('$') or line[3:6] != 'RMC':
+                continue
+            if '*' in line:
+                line, checksum = line.split('*', 1)
+                computed = 0
+                for c in line[1:]:
+                    computed ^= ord(c)
+                try:
+                    if computed != int(checksum[:2], 16):
+                        continue
+                except ValueError:
+                    continue
+            fields = line.split(',')
+            if len(fields) < 10 or fields[2] != 'A' or not fields[3] or not fields[5]:
+                continue
+            try:
+                dt = datetime.datetime.strptime(fields[9] + fields[1][:6], '%d%m%y%H%M%S')
+                if len(fields[1]) > 7:
+                    dt += datetime.timedelta(microseconds=int(float('0' + fields[1][6:]) * 1000000))
+                yield dt, nmea_degrees(fields[3], fields[4]), nmea_degrees(fields[5], fields[6])
+            except ValueError:
+                continue
+
+
+track_readers = {'.gpx': read_gpx,
+                 '.nmea': read_nmea,
+                 '.nma': read_nmea}
+
+
+def export_track(points, filename, local_tz, start_date=None, end_date=None, tolerance=None,
+                 resampling_frequency=60):
+    """Writes (dt, latitude, longitude) tuples with naive UTC timestamps to a coordinates file, one row at a time.
+    Timestamps are written in the local time zone, like for a converted location history, and only the ones between
+    start_date and end_date (naive local datetimes, inclusive) are kept. With tolerance, the track is simplified (see
+    simplify_track) before it is written, which needs all of it in memory. Returns the number of rows written and the
+    first and last time stamps."""
+    # (local time, UTC time, latitude, longitude), the UTC times being needed to simplify tracks across clock changes
+    points = ((pytz.utc.localize(dt).astimezone(local_tz).replace(tzinfo=None), dt, lat, lng)
+              for dt, lat, lng in points)
+    points = (p for p in points if (start_date is None or p[0] >= start_date) and (end_date is None or p[0] <= end_date))
+    if tolerance is not None:
+        points = sorted(points, key=lambda p: p[1])
+        if points:
+            epoch = datetime.datetime(1970, 1, 1)
+            seconds, latitudes, longitudes = simplify_track(
+                np.array([timedelta_microseconds(p[1] - epoch) / 10**6 for p in points]),
+                np.array([p[2] for p in points]), np.array([p[3] for p in points]), tolerance, resampling_frequency)
+            logger.info('Simplified the track from %d to %d locations' % (len(points), len(seconds)))
+            points = [(pytz.utc.localize(epoch + datetime.timedelta(seconds=int(t))).astimezone(local_tz)
+                       .replace(tzinfo=None), None, lat, lng) for t, lat, lng in zip(seconds, latitudes, longitudes)]
+    count, dt_first, dt_last = 0, None, None
+    with open(filename, 'w') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['dt', 'latitude', 'longitude'])
+        for dt, _, lat, lng in points:
+            writer.writerow([dt, lat, lng])
+            count += 1
+            dt_first = dt if dt_first is None else min(dt_first, dt)
+            dt_last = dt if dt_last is None else max(dt_last, dt)
+    return count, dt_first, dt_last
+
+
+def find_location_records(filename, window=1 << 20):
+    """Returns the byte offset of the first record of the "locations" array of a location history file, or None if
+    the array does not start within the first window bytes"""
+    with open(filename, 'rb') as f:
+        head = f.read(window)
+    m = location_array_re.search(head)
+    if m is None:
+        return None
+    return m.end()
+
+
+def next_location_record(f, offset, size, window=1 << 16):
+    """Returns the byte offset of the first location record starting at or after offset in an open location history
+    file, or size if there is none. A candidate "{" is only accepted if it decodes to a record with coordinates, so
+    that the nested activity objects of a record are never mistaken for records"""
+    decoder = json.JSONDecoder()
+    overlap = 64  # so that a separator at the end of a window is seen with the brace following it
+    while offset < size:
+        f.seek(offset)
+        data = f.read(window)
+        truncated = None
+        for m in location_record_re.finditer(data):
+            start = m.end() - 1
+            try:
+                record = decoder.raw_decode(data[start:].decode('utf-8', 'replace'))[0]
+            except ValueError:
+                if offset + len(data) < size:
+                    truncated = m.start()
+                    break
+                continue
+            if isinstance(record, dict) and 'latitudeE7' in record:
+                return offset + start
+        if truncated is not None:
+            # the candidate runs past the window, read it again with a larger one
+            offset += truncated
+            window *= 2
+        elif offset + len(data) >= size:
+            break
+        else:
+            offset += len(data) - overlap
+    return size
+
+
+def location_history_chunks(filename, n_chunks):
+    """Splits the "locations" array of a location history file into at most n_chunks (start, end) byte ranges that
+    each hold whole records. Returns None if the array cannot be found"""
+    first = find_location_records(filename)
+    if first is None:
+        return None
+    size = os.path.getsize(filename)
+    bounds = [first]
+    with open(filename, 'rb') as f:
+        for i in range(1, n_chunks):
+            offset = max(first + (size - first) * i // n_chunks, bounds[-1] + 1)
+            bound = next_location_record(f, offset, size)
+            if bound >= size:
+                break
+            bounds.append(bound)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def filter_location_records(records, local_tz, start_date=None, end_date=None, accuracy=None):
+    """Turns location history records into a DataFrame indexed by naive local time stamps and sorted by time, with
+    columns ts, latitude, longitude and accuracy. Only the records between start_date and end_date (naive local
+    datetimes, inclusive) and with an accuracy of at most accuracy metres are kept. Records can be given as a
+    generator, they are reduced to their fields one at a time"""
+    ts, latitudes, longitudes, accuracies = [], [], [], []
+    for r in records:
+        ts.append(int(r['timestampMs']))
+        latitudes.append(r['latitudeE7'])
+        longitudes.append(r['longitudeE7'])
+        accuracies.append(r['accuracy'])
+    ts = np.array(ts, dtype=np.int64)
+    df = pd.DataFrame({'ts': ts,
+                       'latitude': np.array(latitudes, dtype=np.float64) / 10000000.0,
+                       'longitude': np.array(longitudes, dtype=np.float64) / 10000000.0,
+                       'accuracy': np.array(accuracies, dtype=np.float64)},
+                      columns=['ts', 'latitude', 'longitude', 'accuracy'])
+    # naive timestamps in local timezone
+    df['dt'] = pd.to_datetime(ts, unit='ms').tz_localize('UTC').tz_convert(local_tz).tz_localize(None)
+    if accuracy is not None:
+        df = df[df.accuracy <= accuracy]
+    if start_date is not None:
+        df = df[df.dt >= start_date]
+    if end_date is not None:
+        df = df[df.dt <= end_date]
+    df = df.sort_values(by='ts', kind='mergesort')
+    return df.set_index('dt')
+
+
+def iter_location_records(data):
+    """Generator over the location records of a piece of the "locations" array of a location history file, starting
+    at a record and holding whole records. Records without coordinates are skipped"""
+    decoder = json.JSONDecoder()
+    pos, n = 0, len(data)
+    while True:
+        while pos < n and data[pos] in ' \t\r\n,':
+            pos += 1
+        if pos >= n or data[pos] == ']':
+            return
+        record, pos = decoder.raw_decode(data, pos)
+        if 'latitudeE7' in record:
+            yield record
+
+
+def convert_location_chunk(chunk):
+    """Parses and filters the records of one byte range of a location history file, see location_history_chunks.
+    Takes a (filename, start, end, local_tz, start_date, end_date, accuracy) tuple so that it can be mapped over a
+    process pool"""
+    filename, start, end, local_tz, start_date, end_date, accuracy = chunk
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    if not isinstance(data, str):  # Python 3, where the decoder only takes text. Python 2 parses the bytes faster
+        data = data.decode('utf-8')
+    return filter_location_records(iter_location_records(data), local_tz, start_date, end_date, accuracy)
+
+
+def read_location_history(filename, local_tz, start_date=None, end_date=None, accuracy=None, jobs=1):
+    """Reads a Google location history file into a DataFrame, see filter_location_records. With jobs > 1, the
+    "locations" array is split into chunks at record boundaries, which are parsed and filtered in a pool of
+    processes and merged back in time order"""
+    chunks = location_history_chunks(filename, jobs * 4 if jobs > 1 else 1)
+    if chunks is None:  # not laid out as expected, parse the whole document
+        with open(filename, 'rb') as f:
+            records = json.loads(f.read().decode('utf-8'))['locations']
+        return filter_location_records(records, local_tz, start_date, end_date, accuracy)
+    chunks = [(filename, start, end, local_tz, start_date, end_date, accuracy) for start, end in chunks]
+    logger.debug('Reading %s in %d chunks' % (filename, len(chunks)))
+    if jobs > 1 and len(chunks) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(chunks)))
+        try:
+            dfs = pool.map(convert_location_chunk, chunks)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        dfs = [convert_location_chunk(chunk) for chunk in chunks]
+    dfs = [df for df in dfs if len(df) > 0]
+    if not dfs:
+        return filter_location_records([], local_tz)
+    # location histories are stored in time order, so the sorted chunks usually just need to be put end to end
+    dfs.sort(key=lambda df: df.ts.iat[0])
+    df = pd.concat(dfs)
+    if any(a.ts.iat[-1] > b.ts.iat[0] for a, b in zip(dfs[:-1], dfs[1:])):
+        df = df.sort_values(by='ts', kind='mergesort')
+    return df
+
+
+def find_stays(latitudes, longitudes, radius):
+    """Returns the (start, end) index ranges (end excluded) of the runs of at least 3 consecutive locations that all lie
+    within radius metres of the first location of the run. This is a sequential scan, not a vectorised one: each run
+    starts where the previous one ended, and while moving most runs are a single location, so the distances are
+    computed one at a time on Python floats, which is faster than a numpy call per run"""
+    lat, lng = latitudes.tolist(), longitudes.tolist()
+    coslat = np.cos(np.radians(latitudes)).tolist()
+    k2 = (earth_radius_km * 1000 * np.pi / 180) ** 2
+    r2 = radius ** 2 / k2  # in squared degrees of latitude
+    stays = []
+    start = 0
+    for i in range(1, len(lat) + 1):
+        if i < len(lat):
+            dlng = (lng[i] - lng[start]) * coslat[start]
+            if (lat[i] - lat[start]) ** 2 + dlng * dlng <= r2:
+                continue
+        if i - start >= 3:
+            stays.append((start, i))
+        start = i
+    return stays
+
+
+def simplify_track(seconds, latitudes, longitudes, tolerance, resampling_frequency=60):
+    """Simplifies a time-sorted track, given as numpy arrays of UTC time stamps in seconds since the epoch, latitudes
+    and longitudes. The locations are first averaged over time bins of resampling_frequency seconds, like geotag mode
+    does when it loads the track. The series of means is then simplified so that each of them lies within tolerance
+    metres of the position interpolated linearly in time between the kept ones, which is what geotag mode computes for
+    the bins left empty. Stationary periods (see find_stays, with a radius of tolerance/2) are collapsed to their
+    centroid at their first and last bins, then the track goes through a time-aware Douglas-Peucker simplification,
+    where the error of a segment is measured against all the means it covers at once.
+    Returns the start times of the kept bins, and their latitudes and longitudes."""
+    bins = np.floor(seconds / resampling_frequency).astype(np.int64)
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(bins)) + 1])
+    counts = np.diff(np.concatenate([starts, [len(bins)]]))
+    seconds = bins[starts] * resampling_frequency
+    latitudes = np.add.reduceat(latitudes, starts) / counts
+    longitudes = np.add.reduceat(longitudes, starts) / counts
+    n = len(seconds)
+    if n < 3:
+        return seconds, latitudes, longitudes
+
+    stays = find_stays(latitudes, longitudes, tolerance / 2)
+    lat_c, lng_c = latitudes.copy(), longitudes.copy()
+    interior = np.zeros(n + 1, dtype=np.int64)
+    if stays:
+        starts, ends = np.array(stays).T
+        cum_lat = np.concatenate([[0], np.cumsum(latitudes - latitudes[0])])
+        cum_lng = np.concatenate([[0], np.cumsum(longitudes - longitudes[0])])
+        for cum, coords, origin in ((cum_lat, lat_c, latitudes[0]), (cum_lng, lng_c, longitudes[0])):
+            coords[starts] = coords[ends - 1] = (cum[ends] - cum[starts]) / (ends - starts) + origin
+        np.add.at(interior, starts + 1, 1)
+        np.add.at(interior, ends - 1, -1)
+    # candidates are all the means but the inner ones of stationary periods
+    candidates = np.flatnonzero(np.cumsum(interior[:n]) == 0)
+    lat_c, lng_c = lat_c[candidates], lng_c[candidates]
+
+    k = earth_radius_km * 1000 * np.pi / 180  # metres per degree of latitude
+    coslat = np.cos(np.radians(latitudes))
+    tolerance2 = (tolerance / k) ** 2
+    keep = np.zeros(len(candidates), dtype=bool)
+    keep[[0, -1]] = True
+    segments = [(0, len(candidates) - 1)]
+    while segments:
+        a, b = segments.pop()
+        if b - a < 2:
+            continue
+        i, j = candidates[a], candidates[b] + 1
+        f = (seconds[i:j] - seconds[i]) / float(seconds[j - 1] - seconds[i])
+        dlat = latitudes[i:j] - (lat_c[a] + (lat_c[b] - lat_c[a]) * f)
+        dlng = (longitudes[i:j] - (lng_c[a] + (lng_c[b] - lng_c[a]) * f)) * coslat[i:j]
+        errors = dlat * dlat + dlng * dlng
+        worst = errors.argmax()
+        if errors[worst] <= tolerance2:
+            continue
+        # split at the candidate nearest to the worst mean, which may be inside a stationary period
+        c = candidates.searchsorted(i + worst)
+        if candidates[c] != i + worst and i + worst - candidates[c - 1] < candidates[c] - (i + worst):
+            c -= 1
+        c = min(max(c, a + 1), b - 1)
+        keep[c] = True
+        segments += [(a, c), (c, b)]
+    return seconds[candidates[keep]], lat_c[keep], lng_c[keep]
+
+
+def same_geo(geo_a, geo_b, tolerance=geo_tolerance):
+    """Returns True if two (latitude, longitude) tuples are equal at the precision of EXIF GPS rationals"""
+    return abs(geo_a[0] - geo_b[0]) <= tolerance and abs(geo_a[1] - geo_b[1]) <= tolerance
+
+
+def load_coordinates(filenames, no_header=False):
+    """Loads one or several coordinates files into a DataFrame with columns dt (naive UTC), latitude and longitude"""
+    if len(filenames) == 1:
+        return pd.read_csv(filenames[0],
+                           names=['dt', 'latitude', 'longitude'],
+                           usecols=[0, 1, 2],
+                           parse_dates=['dt'],
+                           skiprows=0 if no_header else 1,
+                           dtype={'latitude': np.float64, 'longitude': np.float64})
+    # the merged rows go into typed columns as they come, rather than into a list of tuples of Python objects.
+    # Microseconds since the epoch are exact in a double until year 2255
+    epoch = datetime.datetime(1970, 1, 1)
+    microseconds, latitudes, longitudes = array('d'), array('d'), array('d')
+    add_microseconds, add_latitude, add_longitude = microseconds.append, latitudes.append, longitudes.append
+    for dt, lat, lng in merge_coordinates(filenames, no_header):
+        td = dt - epoch  # see timedelta_microseconds, inlined as this runs once per location
+        add_microseconds((td.days * 86400 + td.seconds) * 1000000 + td.microseconds)
+        add_latitude(lat)
+        add_longitude(lng)
+    dt = pd.to_datetime(np.frombuffer(microseconds, dtype=np.float64).astype(np.int64), unit='us').values
+    return pd.DataFrame({'dt': dt, 'latitude': np.frombuffer(latitudes, dtype=np.float64),
+                         'longitude': np.frombuffer(longitudes, dtype=np.float64)},
+                        columns=['dt', 'latitude', 'longitude'])
+
+
+def read_coordinates_tail(filename, offset):
+    """Reads the rows appended to a coordinates file after a given byte offset, as (dt, latitude, longitude) tuples.
+    A partially written last line is left for the next call. Returns the rows and the offset to resume from.
+    Raises ValueError if the file shrank, since rows were then rewritten rather than appended."""
+    if os.path.getsize(filename) < offset:
+        raise ValueError('%s was truncated' % filename)
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b'\n') + 1
+    rows = [parse_coordinates_row(row) for row in csv.reader(data[:end].decode('utf-8').splitlines()) if row]
+    return [(dt, lat, lng) for dt, accuracy, lat, lng in rows], offset + end
+
+
+def coordinates_offsets(filenames):
+    """Returns the size of each coordinates file, or None if one of them ends with a partially written line"""
+    offsets = {}
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            offsets[filename] = f.tell()
+            if offsets[filename]:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    return None
+    return offsets
+
+
+def localize_coordinates(dfloc, local_tz):
+    """Converts the naive UTC timestamps of loaded coordinates to naive local times, and makes them the sorted index"""
+    dfloc.dt = dfloc.dt.apply(lambda x: pytz.utc.localize(x).astimezone(local_tz).replace(tzinfo=None))
+    dfloc.set_index('dt', inplace=True)
+    dfloc.sort_index(inplace=True)
+    return dfloc
+
+
+class Track(object):
+    """Resampled time series of coordinates, loaded once and used to locate any number of pictures.
+    Timestamps are naive datetimes in the local time zone given when loading the track.
+
+    Example:
+
+    track = Track.from_csv(['locations.csv'])
+    geotagger = GeoTagger(track, cam_tz=pytz.timezone('UTC'))
+    for result in geotagger.tag_paths(list_jpegs('pictures/')):
+        logger.info('%s: %s' % (result.path, result.outcome))
+    """
+
+    def __init__(self, dfres, dftail, resampling_frequency=60):
+        """Creates a track from resampled coordinates, and the raw locations falling into their last time bin (needed
+        to extend the track). You should rather use one of the class methods from_csv or load."""
+        self.dfres = dfres
+        self.dftail = dftail
+        self.resampling_frequency = resampling_frequency
+        self.version = 0  # incremented whenever the track changes
+
+    @classmethod
+    def from_csv(cls, filenames, no_header=False, local_tz=None, resampling_frequency=60):
+        """Loads, localises and resamples one or several coordinates files"""
+        local_tz = local_tz or get_localzone()
+        dfloc = localize_coordinates(load_coordinates(filenames, no_header), local_tz)
+        logger.debug('Opened coordinates file(s) "%s", %d locations found' % ('", "'.join(filenames), len(dfloc)))
+
+        # resampling time series by taking the mean of points falling within a time bin, and interpolating linearly.
+        # This is very fast only because we use linear interpolation.
+        dfres = dfloc.resample('%dS' % resampling_frequency).mean().interpolate()
+        logger.debug('Resampled coordinates to %d-second frequency, went from %d positions to %d'
+                     % (resampling_frequency, len(dfloc), len(dfres)))
+        return cls(dfres, dfloc[dfloc.index >= dfres.index[-1]], resampling_frequency)
+
+    @classmethod
+    def load(cls, filename):
+        """Loads a track previously written with save"""
+        dfres, dftail, resampling_frequency = pd.read_pickle(filename)
+        return cls(dfres, dftail, resampling_frequency)
+
+    def save(self, filename):
+        """Writes the track to a binary file, which loads much faster than the coordinates files it comes from"""
+        pd.to_pickle((self.dfres, self.dftail, self.resampling_frequency), filename)
+
+    def __len__(self):
+        return len(self.dfres)
+
+    @property
+    def dt_min(self):
+        return self.dfres.index[0].to_pydatetime()
+
+    @property
+    def dt_max(self):
+        return self.dfres.index[-1].to_pydatetime()
+
+    def extend(self, dfnew):
+        """Appends localised locations to the track, resampling only the time bins they fall into.
+        Raises ValueError if the new locations are older than the last time bin, in which case the track has to be
+        reloaded entirely."""
+        dfnew = pd.concat([self.dftail, dfnew]).sort_index()
+        if dfnew.index[0] < self.dfres.index[-1]:
+            raise ValueError('New locations start before the end of the track')
+        dfext = dfnew.resample('%dS' % self.resampling_frequency).mean().interpolate()
+        # the first new bin is the former last one, recomputed with the new locations it may contain
+        self.dfres = pd.concat([self.dfres.iloc[:-1], dfext])
+        self.dftail = dfnew[dfnew.index >= self.dfres.index[-1]]
+        self.version += 1
+
+    def locate(self, dt):
+        """Returns the (latitude, longitude) of the resampled location nearest to a naive local datetime, or None if
+        it cannot be found"""
+        # DatetimeIndex.asof() returns last index in the past, so we need to add half a period to get the nearest one
+        idx = self.dfres.index.asof(dt + datetime.timedelta(seconds=self.resampling_frequency//2))
+        if pd.isnull(idx):  # NaT (or NaN with older pandas) before the start of the track
+            return None
+        return self.dfres.latitude[idx], self.dfres.longitude[idx]
+
+    def locate_many(self, dts):
+        """Vectorised version of locate for a sequence of naive local datetimes within the range of the track"""
+        if not len(dts):
+            return []
+        keys = pd.DatetimeIndex(dts) + pd.Timedelta(seconds=self.resampling_frequency//2)
+        # same as DatetimeIndex.asof(), see locate
+        positions = self.dfres.index.searchsorted(keys, side='right') - 1
+        return list(zip(self.dfres.latitude.values[positions], self.dfres.longitude.values[positions]))
+
+
+class ArrayTrack(object):
+    """Lightweight, read-only counterpart of Track for small coordinates files, which does not need pandas. Only the
+    time bins holding locations are kept, in arrays, and the empty bins in between are interpolated linearly when
+    looked up, so the locations are the same as with Track. It loads in less time than pandas takes to be imported.
+
+    Example:
+
+    track = ArrayTrack.from_csv(['locations.csv'])
+    print(track.locate(datetime.datetime(2016, 3, 27, 7, 0)))
+    """
+
+    def __init__(self, origin, bins, latitudes, longitudes, resampling_frequency=60):
+        """Creates a track from the numbers of the time bins holding locations (counted from the naive local datetime
+        origin, in increasing order) and the mean coordinates in those bins. You should rather use from_csv."""
+        self.origin = origin
+        self.bins = bins
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+        self.resampling_frequency = resampling_frequency
+        self.version = 0  # never changes, the track is read-only
+
+    @classmethod
+    def from_csv(cls, filenames, no_header=False, local_tz=None, resampling_frequency=60):
+        """Loads, localises and bins one or several coordinates files. Unlike Track.from_csv, the files must be
+        sorted by time (ValueError is raised otherwise)"""
+        local_tz = local_tz or get_localzone()
+        if len(filenames) == 1:  # like pandas, keep all the rows of a single file
+            rows = ((dt, lat, lng) for dt, _, lat, lng in read_coordinates(filenames[0], no_header))
+        else:
+            rows = merge_coordinates(filenames, no_header)
+        bin_length = resampling_frequency * 10**6
+        origin = None
+        sums = {}
+        for dt, lat, lng in rows:
+            dt = pytz.utc.localize(dt).astimezone(local_tz).replace(tzinfo=None)
+            if origin is None:  # bins are anchored at midnight, like in pandas
+                origin = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+            # local times are not sorted when clocks go back, so bins cannot be closed as we go
+            b = timedelta_microseconds(dt - origin) // bin_length
+            s = sums.get(b)
+            if s is None:
+                sums[b] = [lat, lng, 1]
+            else:
+                s[0] += lat
+                s[1] += lng
+                s[2] += 1
+        if not sums:
+            raise ValueError('No locations found in "%s"' % '", "'.join(filenames))
+        bins = array('l', sorted(sums))
+        latitudes = array('d', [sums[b][0] / sums[b][2] for b in bins])
+        longitudes = array('d', [sums[b][1] / sums[b][2] for b in bins])
+        logger.debug('Opened coordinates file(s) "%s", %d time bins of %d seconds hold locations'
+                     % ('", "'.join(filenames), len(bins), resampling_frequency))
+        return cls(origin, bins, latitudes, longitudes, resampling_frequency)
+
+    def __len__(self):
+        return self.bins[-1] - self.bins[0] + 1
+
+    @property
+    def dt_min(self):
+        return self.origin + datetime.timedelta(seconds=self.bins[0] * self.resampling_frequency)
+
+    @property
+    def dt_max(self):
+        return self.origin + datetime.timedelta(seconds=self.bins[-1] * self.resampling_frequency)
+
+    def locate(self, dt):
+        """Returns the (latitude, longitude) of the resampled location nearest to a naive local datetime, or None if
+        it cannot be found"""
+        # nearest bin, then the last one holding locations at or before it (same as Track.locate)
+        b = (timedelta_microseconds(dt - self.origin) + self.resampling_frequency // 2 * 10**6) // \
+            (self.resampling_frequency * 10**6)
+        i = bisect_right(self.bins, b) - 1
+        if i < 0:
+            return None
+        if self.bins[i] == b or i == len(self.bins) - 1:
+            return self.latitudes[i], self.longitudes[i]
+        # empty bin: linear interpolation between the bins around it, computed like numpy.interp
+        steps = self.bins[i + 1] - self.bins[i]
+        return ((self.latitudes[i + 1] - self.latitudes[i]) / steps * (b - self.bins[i]) + self.latitudes[i],
+                (self.longitudes[i + 1] - self.longitudes[i]) / steps * (b - self.bins[i]) + self.longitudes[i])
+
+    def locate_many(self, dts):
+        """Same as locate for a sequence of naive local datetimes within the range of the track"""
+        return [self.locate(dt) for dt in dts]
+
+
+def timedelta_microseconds(td):
+    """Returns the length of a timedelta as an exact number of microseconds"""
+    return (td.days * 86400 + td.seconds) * 10**6 + td.microseconds
+
+
+class TrackCache(object):
+    """On-disk cache of loaded tracks, so that the same coordinates files are only parsed and resampled once. Entries
+    are keyed by the size and modification time of the files and by the parameters of the track, and the least
+    recently used ones are evicted when the cache grows over max_size bytes.
+
+    Example:
+
+    cache = TrackCache(max_size=256 * 2**20)
+    track = cache.load(['locations.csv'], local_tz=pytz.timezone('Europe/Zurich'))
+    """
+
+    def __init__(self, directory=None, max_size=track_cache_size):
+        self.directory = directory or default_cache_dir()
+        self.max_size = max_size
+
+    def key(self, filenames, no_header, local_tz, resampling_frequency):
+        """Returns the cache key of a track, which changes whenever one of its files is modified"""
+        files = []
+        for filename in filenames:
+            st = os.stat(filename)
+            files.append([os.path.abspath(filename), st.st_size, st.st_mtime])
+        # pickles are not portable between versions of pandas
+        params = [track_cache_version, pd.__version__, files, bool(no_header), str(local_tz), resampling_frequency]
+        return hashlib.sha1(json.dumps(params).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.track')
+
+    def load(self, filenames, no_header=False, local_tz=None, resampling_frequency=60):
+        """Returns the track of one or several coordinates files (see Track.from_csv), from the cache if possible"""
+        local_tz = local_tz or get_localzone()
+        key = self.key(filenames, no_header, local_tz, resampling_frequency)
+        path = self.path(key)
+        try:
+            track = Track.load(path)
+            os.utime(path, None)  # most recently used
+            logger.debug('Loaded track from cache %s' % path)
+            return track
+        except (IOError, OSError):
+            pass
+        except Exception:
+            logger.debug('Discarding unreadable cached track %s: %s' % (path, sys.exc_info()[1]))
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        track = Track.from_csv(filenames, no_header, local_tz, resampling_frequency)
+        # a file written to while it was loaded would be cached under a key that does not match its content
+        if self.key(filenames, no_header, local_tz, resampling_frequency) == key:
+            self.store(track, path)
+        return track
+
+    def store(self, track, path):
+        """Writes a track to the cache, then evicts the least recently used entries"""
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            track.save(tmp_path)
+            os.rename(tmp_path, path)
+            logger.debug('Cached track to %s' % path)
+        except (IOError, OSError):
+            logger.debug('Could not cache track to %s' % path)
+            return
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the cache is no larger than max_size"""
+        entries = []
+        for path in glob.glob(os.path.join(self.directory, '*.track')):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                logger.debug('Evicted %s from the track cache' % path)
+            except OSError:
+                continue
+            total -= size
+
+
+def default_cache_dir():
+    """Returns the directory where tracks are cached by default, following the XDG base directory specification"""
+    root = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(root, 'pybatchgeotag')
+
+
+# Result of geotagging one picture. outcome is one of 'tagged', 'unchanged', 'existing geodata', 'out of range',
+# 'no datetime', 'no EXIF' or 'error'. datetime is the local time of the picture, latitude and longitude the
+# coordinates it was (or would have been) given; they are None when not known. image_hash is the hash of the image
+# data of the pictures rewritten with verification on (see image_hash), and None otherwise
+TagResult = namedtuple('TagResult', ['path', 'outcome', 'datetime', 'latitude', 'longitude', 'image_hash'])
+TagResult.__new__.__defaults__ = (None,)
+tag_outcomes = ['tagged', 'unchanged', 'existing geodata', 'out of range', 'no datetime', 'no EXIF', 'error']
+
+
+class MemoryBudget(object):
+    """Thread-safe count of the bytes held by pictures being processed, bounded by limit. A picture larger than the
+    whole budget is still admitted when nothing else is in flight, so that it can be processed on its own."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size, blocking=True):
+        """Reserves size bytes, waiting for them to be released if blocking. Returns False if they could not be
+        reserved without waiting"""
+        with self.condition:
+            while self.used and self.used + size > self.limit:
+                if not blocking:
+                    return False
+                self.condition.wait()
+            self.used += size
+            return True
+
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+def load_posix_fadvise():
+    """Returns posix_fadvise(fd, offset, length, advice), or None on systems without it. os only has it from Python 3.3,
+    so with Python 2 it is the function of the C library, through ctypes, which returns errors rather than raising
+    them: advice is only a hint."""
+    if hasattr(os, 'posix_fadvise'):
+        return os.posix_fadvise
+    try:
+        libc = ctypes.CDLL(None)
+        fadvise = getattr(libc, 'posix_fadvise64', None) or libc.posix_fadvise
+    except (AttributeError, OSError):  # no ctypes, or no such function (e.g. on macOS and Windows)
+        return None
+    fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+    fadvise.restype = ctypes.c_int
+    return fadvise
+
+
+posix_fadvise = load_posix_fadvise()
+
+
+class HeaderFile(object):
+    """Read-only file object of a JPEG file whose header (its first bytes) was read beforehand, see
+    prefetch_headers. Reads within the header are served from memory, and the rest of the file is only read if needed,
+    from fd (an open descriptor of the file, opened on first use if None). Closing it drops the file from the page
+    cache where posix_fadvise is available, as a batch run reads each picture once."""
+
+    def __init__(self, path, header=b'', fd=None):
+        self.path = path
+        self.header = header
+        self.fd = fd
+        self.file = None
+        self.pos = 0
+
+    def read(self, size=-1):
+        end = len(self.header)
+        if 0 <= size and self.pos + size <= end:
+            data = self.header[self.pos:self.pos + size]
+            self.pos += size
+            return data
+        data = self.header[self.pos:]
+        if self.file is None:
+            if self.fd is None:
+                self.fd = os.open(self.path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+            self.file = os.fdopen(self.fd, 'rb')
+        start = max(self.pos, end)
+        if self.file.tell() != start:
+            self.file.seek(start)
+        rest = self.file.read(size - len(data) if size >= 0 else -1)
+        self.pos = start + len(rest)
+        return data + rest
+
+    def seek(self, offset, whence=0):
+        if whence == 2:
+            offset += os.fstat(self.fd).st_size if self.fd is not None else os.path.getsize(self.path)
+        elif whence == 1:
+            offset += self.pos
+        self.pos = offset
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if self.fd is None:
+            return
+        if posix_fadvise is not None:
+            posix_fadvise(self.fd, 0, 0, posix_fadv_dontneed)
+        if self.file is not None:
+            self.file.close()
+        else:
+            os.close(self.fd)
+        self.fd = self.file = None
+
+
+def read_header(path, size=MAX_HEADER_SIZE):
+    """Opens a file and reads its first size bytes, in one request to the disk where posix_fadvise is available.
+    Returns a HeaderFile holding them, to be closed by the caller."""
+    fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        if posix_fadvise is not None:
+            posix_fadvise(fd, 0, size, posix_fadv_willneed)
+        header = os.read(fd, size)  # the descriptor was just opened, so this reads from the start of the file
+    except:
+        os.close(fd)
+        raise
+    return HeaderFile(path, header, fd)
+
+
+def prefetch_headers(paths, ahead=8, threads=prefetch_threads):
+    """Generator yielding a HeaderFile for each of paths, in order, to be closed by the caller. Their headers are
+    read by a pool of threads, up to ahead files in advance, so that the parser rarely waits for the disk. Files that
+    cannot be read yield an empty HeaderFile, which fails when read, like the file itself would."""
+    tasks = Queue()
+    ready = {}  # HeaderFile by position in paths, until yielded
+    condition = threading.Condition()
+
+    def work():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            index, path = task
+            try:
+                source = read_header(path)
+            except:
+                source = HeaderFile(path)
+            with condition:
+                ready[index] = source
+                condition.notify()
+
+    def take(index):
+        with condition:
+            while index not in ready:
+                condition.wait()
+            return ready.pop(index)
+
+    workers = [threading.Thread(target=work) for _ in range(max(min(threads, ahead), 1))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    count = taken = 0
+    try:
+        for path in paths:
+            if count - taken >= ahead:
+                yield take(taken)
+                taken += 1
+            tasks.put((count, path))
+            count += 1
+        while taken < count:
+            yield take(taken)
+            taken += 1
+    finally:
+        for worker in workers:
+            tasks.put(None)
+        while taken < count:  # not consumed, e.g. on an error
+            take(taken).close()
+            taken += 1
+        for worker in workers:
+            worker.join()
+
+
+class GeoTagger(object):
+    """Geotags pictures using a preloaded Track. See Track for an example."""
+
+    max_groups = 1024
+
+    def __init__(self, track, cam_tz=None, local_tz=None, overwrite=False, sidecar=False, verify=False):
+        """cam_tz is the time zone of the camera clock, and local_tz the one of the track (both default to the local
+        time zone). When overwrite is False, pictures that already have geodata are left alone. When sidecar is True,
+        tag_paths writes the geodata to XMP sidecar files and only ever reads the pictures. When verify is True, the
+        image data of the pictures tag_paths rewrites is hashed before they are written, and they are only written if
+        it is the same as in the file, then hashed again in the written file: pictures whose image data would change
+        or changed are errors, and the others have the hash in their TagResult."""
+        self.track = track
+        self.local_tz = local_tz or get_localzone()
+        self.cam_tz = cam_tz or self.local_tz
+        self.overwrite = overwrite
+        self.sidecar = sidecar
+        self.verify = verify
+        self.groups = OrderedDict()
+        self.groups_lock = threading.Lock()  # pictures may be geotagged from several threads
+        self.groups_version = None
+        self.group_hits = 0
+        self.group_misses = 0
+
+    def localize(self, dt):
+        """Parses a camera time stamp (in one of the datetime_formats) and converts it to the naive local time of the
+        track. Returns None if it cannot be parsed."""
+        dt = parse_exif_datetime(dt)
+        if dt is None:
+            return None
+        # localising image to local timezone, since location timestamps are local
+        return self.cam_tz.localize(dt).astimezone(self.local_tz).replace(tzinfo=None)
+
+    def group(self, timestamp):
+        """Returns what tag_jpeg needs to know about a raw EXIF time stamp, as a list: local datetime (None if it
+        cannot be parsed), whether it is within the track, its (latitude, longitude) (None if unknown) and the GPS tag
+        values encoding them (None until set by tag_jpeg).
+        Bursts of pictures share the same time stamp, so the last max_groups time stamps are memoised, until the
+        track changes."""
+        with self.groups_lock:
+            return self.get_group(timestamp)
+
+    def get_group(self, timestamp):
+        if self.groups_version != self.track.version:
+            self.groups.clear()
+            self.groups_version = self.track.version
+        group = self.groups.get(timestamp)
+        if group is not None:
+            self.group_hits += 1
+            return group
+        self.group_misses += 1
+        dt = self.localize(timestamp)
+        in_range = dt is not None and self.track.dt_min <= dt <= self.track.dt_max
+        group = [dt, in_range, self.track.locate(dt) if in_range else None, None]
+        self.groups[timestamp] = group
+        if len(self.groups) > self.max_groups:
+            self.groups.popitem(last=False)
+        return group
+
+    def group_message(self):
+        """Formats the hit rate of the time stamp memoisation for the end of a run"""
+        lookups = self.group_hits + self.group_misses
+        return 'Pictures sharing a time stamp with a previous one: %d of %d (%0.1f%%)' % \
+            (self.group_hits, lookups, 100.0 * self.group_hits / lookups if lookups else 0)
+
+    def locate(self, timestamps):
+        """Returns the (latitude, longitude) of each camera time stamp in a sequence, or None for time stamps that
+        cannot be parsed or are outside of the track"""
+        dts = [self.localize(ts) for ts in timestamps]
+        valid = [i for i, dt in enumerate(dts) if dt is not None and self.track.dt_min <= dt <= self.track.dt_max]
+        locations = [None] * len(dts)
+        for i, geo in zip(valid, self.track.locate_many([dts[i] for i in valid])):
+            locations[i] = geo
+        return locations
+
+    def memory_cost(self, size):
+        """Estimates the bytes held while geotagging a picture of a given file size: the file data, and in place the
+        output written from it"""
+        return size if self.sidecar else 2 * size
+
+    def tag_paths(self, paths, threads=1, budget=None, prefetch=0):
+        """Geotags JPEG files in place, or their sidecar files. Generator yielding a TagResult for each file.
+        With threads > 1, that many files are processed at once, and results are yielded in the order they complete.
+        budget is then an optional MemoryBudget: paths are only taken from paths (which can be a generator listing
+        files) while the pictures in flight fit into it. With prefetch > 0, the headers of that many files are read
+        in advance, see prefetch_headers."""
+        if prefetch > 0:
+            sources = ((source.path, source) for source in prefetch_headers(paths, prefetch))
+        else:
+            sources = ((path, None) for path in paths)
+
+        def tag_source(path, source):
+            try:
+                return self.tag_path(path, source)
+            finally:
+                if source is not None:
+                    source.close()
+
+        if threads <= 1:
+            for path, source in sources:
+                yield tag_source(path, source)
+            return
+        tasks, results = Queue(), Queue()
+
+        def work():
+            while True:
+                task = tasks.get()
+                if task is None:
+                    return
+                path, source, cost = task
+                try:
+                    result = tag_source(path, source)
+                except:
+                    logger.error('Could not geotag %s: %s' % (path, sys.exc_info()[1]))
+                    result = TagResult(path, 'error', None, None, None)
+                if budget is not None:
+                    budget.release(cost)
+                results.put(result)
+
+        workers = [threading.Thread(target=work) for _ in range(threads)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        pending = 0
+        try:
+            for path, source in sources:
+                try:
+                    cost = self.memory_cost(os.path.getsize(path))
+                except OSError:
+                    cost = 0
+                # backpressure: wait for pictures to be done while the queue or the budget is full
+                while pending >= 2 * threads or (budget is not None and not budget.acquire(cost, blocking=False)):
+                    yield results.get()
+                    pending -= 1
+                tasks.put((path, source, cost))
+                pending += 1
+                while pending:
+                    try:
+                        result = results.get_nowait()
+                    except Empty:
+                        break
+                    pending -= 1
+                    yield result
+            while pending:
+                yield results.get()
+                pending -= 1
+        finally:
+            for worker in workers:
+                tasks.put(None)
+
+    def tag_path(self, path, source=None):
+        """Geotags a JPEG file in place, or its sidecar file. Returns a TagResult. source is an optional file object
+        of the picture, e.g. a HeaderFile, read instead of opening path. Only the metadata at the start of the picture
+        is read when geotagging its sidecar file."""
+        logger.debug('Opening %s to read EXIF data', path)
+        try:
+            if source is None:
+                jf = JpegFile.fromFile(path, mode='ro' if self.sidecar else 'rw', headers_only=self.sidecar)
+            else:
+                jf = JpegFile(source, filename=path, mode='ro' if self.sidecar else 'rw', headers_only=self.sidecar)
+        except:
+            logger.error('Could not open %s. This file does not appear to have a valid EXIF structure' % path)
+            return TagResult(path, 'error', None, None, None)
+        if self.sidecar:
+            xmp_path = sidecar_path(path)
+            try:
+                # the coordinates of an existing sidecar file are compared, not those in EXIF which it overrides
+                result = self.tag_jpeg(jf, path, read_xmp_geo(xmp_path), exif_geo=not os.path.isfile(xmp_path))
+                if result.outcome == 'tagged':
+                    write_xmp_geo(xmp_path, result.latitude, result.longitude)
+            except (IOError, OSError, ET.ParseError):
+                logger.error('Could not update sidecar file %s: %s' % (xmp_path, sys.exc_info()[1]))
+                result = TagResult(path, 'error', None, None, None)
+        else:
+            result = self.tag_jpeg(jf, path)
+            try:
+                if result.outcome == 'tagged' and self.verify:
+                    # the image data about to be written is compared with that of the file first: pexif keeps it up
+                    # to the first end of image marker only, dropping e.g. the secondary images of Motion Photo or
+                    # MPF files after it
+                    buffers, image_start = jf.gather_buffers()
+                    digest = hashlib.new(image_hash_name)
+                    for buf in buffers[image_start:]:
+                        digest.update(buf)
+                    if digest.hexdigest() != image_hash(path):
+                        logger.error('Image data of %s would change when writing it, e.g. data after its end of image '
+                                     'marker would be lost. Leaving file unchanged' % path)
+                        result = result._replace(outcome='error')
+                    else:
+                        jf.writeFile(path, buffers)
+                        result = result._replace(image_hash=digest.hexdigest())
+                        if image_hash(path) != result.image_hash:
+                            logger.error('Image data of %s changed when writing it' % path)
+                            result = result._replace(outcome='error')
+                elif result.outcome == 'tagged':
+                    jf.writeFile(path)
+            except (IOError, OSError, JpegFile.InvalidFile):
+                logger.error('Could not write %s: %s' % (path, sys.exc_info()[1]))
+                result = TagResult(path, 'error', None, None, None)
+        return result
+
+    def tag_bytes(self, buf, name='buffer'):
+        """Geotags a JPEG image held in memory. Returns a TagResult named after name, and the geotagged image (which is
+        buf itself if it was not modified)"""
+        try:
+            jf = JpegFile.fromString(buf)
+        except:
+            logger.error('Could not open %s. This file does not appear to have a valid EXIF structure' % name)
+            return TagResult(name, 'error', None, None, None), buf
+        result = self.tag_jpeg(jf, name)
+        if result.outcome == 'tagged':
+            buf = jf.writeString()
+        return result, buf
+
+    def tag_jpeg(self, jf, name, old_geo=None, exif_geo=True):
+        """Sets the geodata of a JpegFile object, without writing it out. Returns a TagResult named after name.
+        old_geo are existing (latitude, longitude) coordinates kept elsewhere, used if the file has none in EXIF, or
+        in any case if exif_geo is False (e.g. those of a sidecar file, which is what gets written).
+        Read-only JpegFile objects are left unchanged, only the result is computed.
+        Messages are formatted lazily, as most runs leave them out and there is one per picture."""
+        try:
+            exif = jf.get_exif().get_primary()
+        except:
+            file_logger.info('Could not read EXIF data from %s. Skipping file', name)
+            return TagResult(name, 'no EXIF', None, None, None)
+        try:
+            img_dt = exif.ExtendedEXIF.DateTimeOriginal
+            logger.debug('Read DateTimeOriginal for %s: %s', name, img_dt)
+        except:
+            try:
+                img_dt = exif.ExtendedEXIF.DateTimeDigitized
+                logger.debug('Read DateTimeDigitized for %s: %s', name, img_dt)
+            except:
+                try:
+                    img_dt = exif.DateTime
+                    logger.debug('Read DateTime for %s: %s', name, img_dt)
+                except:
+                    file_logger.info('No datetime information found in EXIF for %s. Skipping file', name)
+                    return TagResult(name, 'no datetime', None, None, None)
+
+        group = self.group(img_dt)
+        img_dt, in_range, geo = group[:3]
+        if img_dt is None:  # parsing failed:
+            file_logger.info('Could not parse valid datetime information from EXIF for %s. Skipping file', name)
+            return TagResult(name, 'no datetime', None, None, None)
+
+        if not in_range:
+            if file_logger.isEnabledFor(logging.INFO):
+                file_logger.info('Datetime information for %s (%s) is outside of target range. Skipping file',
+                                 name, img_dt.strftime('%Y-%m-%d %H:%M:%S%z'))
+            return TagResult(name, 'out of range', img_dt, None, None)
+
+        if exif_geo:
+            try:
+                old_geo = jf.get_geo()  # (latitude, longitude)
+            except:
+                pass
+
+        if old_geo is not None and not self.overwrite:
+            file_logger.info('Found existing geodata for %s. Skipping file', name)
+            return TagResult(name, 'existing geodata', img_dt, old_geo[0], old_geo[1])
+
+        if geo is None:
+            logger.error('Could not interpolate time index for %s. Skipping file' % name)
+            return TagResult(name, 'error', img_dt, None, None)
+        lat_, lng_ = geo
+
+        if old_geo is not None and same_geo(old_geo, geo):
+            file_logger.info('Existing geodata for %s is already (%0.6f, %0.6f). Leaving file unchanged',
+                             name, lat_, lng_)
+            return TagResult(name, 'unchanged', img_dt, lat_, lng_)
+
+        file_logger.info('Setting geodata for %s to (%0.6f, %0.6f)', name, lat_, lng_)
+        if jf.mode == 'rw':
+            if group[3] is None:
+                group[3] = JpegFile.encode_geo(lat_, lng_)
+            jf.set_encoded_geo(group[3])
+        return TagResult(name, 'tagged', img_dt, lat_, lng_)
+
+
+def unit_vectors(latitudes, longitudes):
+    """Converts coordinates in degrees to an (n, 3) array of points on the unit sphere, in which euclidean nearest
+    neighbours are also nearest neighbours on the Earth"""
+    lat = np.radians(np.asarray(latitudes, dtype=np.float64))
+    lng = np.radians(np.asarray(longitudes, dtype=np.float64))
+    return np.column_stack([np.cos(lat) * np.cos(lng), np.cos(lat) * np.sin(lng), np.sin(lat)])
+
+
+class PlaceIndex(object):
+    """Offline reverse geocoder: spatial index over the places of a GeoNames gazetteer (e.g. cities1000.txt from
+    http://download.geonames.org/export/dump/). Requires scipy.
+
+    Example:
+
+    places = PlaceIndex.load('cities1000.txt')
+    places.nearest([47.37], [8.54])  # [('Zurich', 'CH', 0.3...)]
+    """
+
+    # columns of the GeoNames main table that we need: name, latitude, longitude, country code
+    geonames_columns = [1, 4, 5, 8]
+
+    def __init__(self, places, tree):
+        """places is a DataFrame with columns name and country, in the order of the points of the cKDTree tree. You
+        should rather use load."""
+        self.places = places
+        self.tree = tree
+
+    @classmethod
+    def from_geonames(cls, filename):
+        """Builds the index from a GeoNames gazetteer file"""
+        try:
+            from scipy.spatial import cKDTree
+        except ImportError:
+            raise ImportError('Reverse geocoding requires scipy')
+        df = pd.read_csv(filename, sep='\t', header=None, usecols=cls.geonames_columns,
+                         names=['name', 'latitude', 'longitude', 'country'], quoting=csv.QUOTE_NONE,
+                         keep_default_na=False, dtype={'name': str, 'country': str})
+        logger.debug('Read %d places from %s' % (len(df), filename))
+        return cls(df[['name', 'country']], cKDTree(unit_vectors(df.latitude.values, df.longitude.values)))
+
+    @classmethod
+    def load(cls, filename):
+        """Loads the index of a GeoNames gazetteer file from its cache (the same file name with a .kdtree extension),
+        building and caching it first if the cache is missing or older than the gazetteer"""
+        cache = filename + '.kdtree'
+        st = os.stat(filename)
+        key = (st.st_size, st.st_mtime)
+        try:
+            cached_key, places, tree = pd.read_pickle(cache)
+            if cached_key == key:
+                return cls(places, tree)
+        except (IOError, OSError):
+            pass
+        except Exception:
+            # truncated, or pickled by incompatible versions of pandas or scipy: rebuild it
+            logger.debug('Discarding unreadable place index %s: %s' % (cache, sys.exc_info()[1]))
+            try:
+                os.remove(cache)
+            except OSError:
+                pass
+        index = cls.from_geonames(filename)
+        try:
+            pd.to_pickle((key, index.places, index.tree), cache)
+        except (IOError, OSError):
+            logger.debug('Could not cache place index to %s' % cache)
+        return index
+
+    def nearest(self, latitudes, longitudes):
+        """Returns the (name, country code, distance in km) of the nearest place to each coordinate, in a single
+        vectorised query"""
+        if not len(latitudes):
+            return []
+        chord, idx = self.tree.query(unit_vectors(latitudes, longitudes))
+        distances = 2 * np.arcsin(np.minimum(chord / 2, 1)) * earth_radius_km
+        return list(zip(self.places.name.values[idx], self.places.country.values[idx], distances))
+
+
+def write_report(filename, results, places=None):
+    """Writes TagResults to a CSV file, one row per picture. If a PlaceIndex is given, the nearest place to the
+    coordinates of each picture is added, with all coordinates resolved at once."""
+    columns = list(TagResult._fields)
+    names = {}
+    if places is not None:
+        columns += ['place', 'country', 'place_distance_km']
+        located = [i for i, r in enumerate(results) if r.latitude is not None]
+        names = dict(zip(located, places.nearest([results[i].latitude for i in located],
+                                                 [results[i].longitude for i in located])))
+    with open(filename, 'w') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(columns)
+        for i, r in enumerate(results):
+            row = ['' if v is None else v for v in r]
+            if places is not None:
+                row += ['', '', ''] if i not in names else [names[i][0], names[i][1], '%0.3f' % names[i][2]]
+            writer.writerow(row)
+
+
+def merge_reports(filenames, output=None):
+    """Combines report files written by write_report (e.g. one per shard) into output, if given, and returns a
+    Counter of their outcomes. The files are streamed, and must all have the same columns."""
+    summary = Counter()
+    seen = set()
+    writer = None
+    f_out = open(output, 'w') if output is not None else None
+    try:
+        for filename in filenames:
+            with open(filename) as f:
+                reader = csv.reader(f)
+                header = next(reader)
+                if f_out is not None and writer is None:
+                    writer = csv.writer(f_out, lineterminator='\n')
+                    writer.writerow(header)
+                    columns = header
+                elif f_out is not None and header != columns:
+                    raise ValueError('%s does not have the same columns as %s' % (filename, filenames[0]))
+                path_idx, outcome_idx = header.index('path'), header.index('outcome')
+                for row in reader:
+                    if row[path_idx] in seen:
+                        logger.warning('%s appears in several report files' % row[path_idx])
+                    seen.add(row[path_idx])
+                    summary[row[outcome_idx]] += 1
+                    if writer is not None:
+                        writer.writerow(row)
+            logger.debug('Merged %s' % filename)
+    finally:
+        if f_out is not None:
+            f_out.close()
+    return summary
+
+
+def inventory_file(path, source=None):
+    """Returns the row of a JPEG file in the inventory, as a tuple of the inventory_columns. Only the metadata at the
+    start of the file is read, from source (e.g. a HeaderFile) if given. The datetime is the naive camera time of the
+    picture. Fields that cannot be read are None."""
+    size = dt = make = model = geo = dimensions = None
+    try:
+        size = os.path.getsize(path)
+        if source is None:
+            jf = JpegFile.fromFile(path, mode='ro', headers_only=True)
+        else:
+            jf = JpegFile(source, filename=path, mode='ro', headers_only=True)
+        dimensions = jf.get_dimensions()
+        exif = jf.get_exif()
+        primary = exif.get_primary() if exif is not None else None
+        if primary is not None:
+            make, model = primary['Make'], primary['Model']
+            extended = primary['ExtendedEXIF']
+            timestamps = [extended['DateTimeOriginal'], extended['DateTimeDigitized']] if extended is not None else []
+            for timestamp in timestamps + [primary['DateTime']]:
+                if timestamp is not None:
+                    dt = parse_exif_datetime(timestamp)
+                    break
+            try:
+                geo = jf.get_geo()
+            except:
+                pass
+    except:
+        logger.debug('Could not read EXIF data from %s: %s' % (path, sys.exc_info()[1]))
+    return (path, size, dt, make and make.strip(), model and model.strip(), geo and geo[0], geo and geo[1],
+            dimensions and dimensions[0], dimensions and dimensions[1])
+
+
+def inventory_rows(paths, prefetch=0):
+    """Returns the inventory rows of a list of JPEG files, see inventory_file. With prefetch > 0, the headers of that
+    many files are read in advance, see prefetch_headers. Mapped over a process pool by write_inventory"""
+    if prefetch <= 0:
+        return [inventory_file(path) for path in paths]
+    rows = []
+    for source in prefetch_headers(paths, prefetch):
+        try:
+            rows.append(inventory_file(source.path, source))
+        finally:
+            source.close()
+    return rows
+
+
+class InventoryWriter(object):
+    """Writes inventory rows batch by batch: to a Parquet file, one row group per batch, if the file name ends with
+    .parquet (requires pyarrow), and to a CSV file otherwise"""
+
+    def __init__(self, filename):
+        self.parquet = filename.endswith('.parquet')
+        if self.parquet:
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                raise ImportError('Writing Parquet files requires pyarrow')
+            self.pa = pyarrow
+            self.schema = pyarrow.schema([('path', pyarrow.string()), ('size', pyarrow.int64()),
+                                          ('datetime', pyarrow.timestamp('s')), ('make', pyarrow.string()),
+                                          ('model', pyarrow.string()), ('latitude', pyarrow.float64()),
+                                          ('longitude', pyarrow.float64()), ('width', pyarrow.int32()),
+                                          ('height', pyarrow.int32())])
+            self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema)
+        else:
+            self.f = open(filename, 'w')
+            self.writer = csv.writer(self.f, lineterminator='\n')
+            self.writer.writerow(inventory_columns)
+
+    def write(self, rows):
+        if not rows:
+            return
+        if not self.parquet:
+            self.writer.writerows(['' if v is None else v for v in row] for row in rows)
+            return
+        columns = list(zip(*rows))
+        for i in (0, 3, 4):  # EXIF strings are bytes on Python 2, and not always valid UTF-8
+            columns[i] = [v.decode('utf-8', 'replace') if isinstance(v, bytes) else v for v in columns[i]]
+        arrays = [self.pa.array(list(column), type=field.type) for column, field in zip(columns, self.schema)]
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        if self.parquet:
+            self.writer.close()
+        else:
+            self.f.close()
+
+
+def write_inventory(filename, paths, jobs=1, batch_size=inventory_batch_size, prefetch=0):
+    """Writes the inventory of JPEG files to filename with an InventoryWriter, reading their metadata in a pool of jobs
+    processes, each prefetching the headers of prefetch files (see inventory_rows). paths can be a generator (see
+    iter_jpegs): it is consumed batch by batch, with at most two batches per process in flight, so that memory use does
+    not depend on the number of files. Rows are written in the order of paths. Returns the number of files and their
+    total size."""
+    pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+    writer = InventoryWriter(filename)
+    totals = [0, 0]
+
+    def write_batch(task):
+        rows = task.get() if pool is not None else inventory_rows(task, prefetch)
+        writer.write(rows)
+        totals[0] += len(rows)
+        totals[1] += sum(row[1] or 0 for row in rows)
+        logger.debug('Wrote the inventory of %d files' % totals[0])
+
+    try:
+        pending = deque()
+        for batch in iter_batches(paths, batch_size):
+            pending.append(pool.apply_async(inventory_rows, (batch, prefetch)) if pool is not None else batch)
+            if len(pending) > 2 * jobs:
+                write_batch(pending.popleft())
+        while pending:
+            write_batch(pending.popleft())
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        writer.close()
+    return totals[0], totals[1]
+
+
+def image_hash(path):
+    """Returns the hash (hex digest, see image_hash_name) of the image data of a JPEG file, from its first start of
+    scan segment to its end, which geotagging must leave unchanged. Only the headers of the segments before it are read, and
+    the image data is hashed as it is read, without being decoded."""
+    digest = hashlib.new(image_hash_name)
+    with open(path, 'rb') as f:
+        f.seek(find_image_data(f))
+        while True:
+            chunk = f.read(image_hash_chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def verify_reports(filenames):
+    """Checks that the image data of the pictures in report files (written by write_report after geotagging with
+    verification on) still has the hash recorded then. Returns a Counter of 'intact', 'changed' and 'unreadable'
+    pictures; pictures without a recorded hash, e.g. because they were not rewritten, are not counted."""
+    summary = Counter()
+    for filename in filenames:
+        with open(filename) as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            if 'image_hash' not in header:
+                raise ValueError('%s has no image_hash column' % filename)
+            path_idx, hash_idx = header.index('path'), header.index('image_hash')
+            for row in reader:
+                if not row[hash_idx]:
+                    continue
+                try:
+                    intact = image_hash(row[path_idx]) == row[hash_idx]
+                except:
+                    logger.error('Could not read the image data of %s: %s' % (row[path_idx], sys.exc_info()[1]))
+                    summary['unreadable'] += 1
+                    continue
+                if not intact:
+                    logger.error('Image data of %s changed since it was geotagged' % row[path_idx])
+                summary['intact' if intact else 'changed'] += 1
+    return summary
+
+
+def sidecar_path(filename):
+    """Returns the name of the XMP sidecar file of a picture: same name, with the extension replaced by .xmp"""
+    return os.path.splitext(filename)[0] + '.xmp'
+
+
+def xmp_coordinate(value, refs):
+    """Formats a latitude (refs 'NS') or longitude (refs 'EW') in XMP's "DDD,MM.mmmmk" format"""
+    ref = refs[0] if value >= 0 else refs[1]
+    value = abs(value)
+    degrees = int(value)
+    # 10 decimals of minutes are finer than what EXIF rationals encode, so that same_geo still works
+    return '%d,%.10f%s' % (degrees, (value - degrees) * 60, ref)
+
+
+def parse_xmp_coordinate(s):
+    """Parses an XMP coordinate ("DDD,MM.mmmmk" or "DDD,MM,SSk") into signed decimal degrees"""
+    s = s.strip()
+    parts = [float(p) for p in s[:-1].split(',')]
+    value = parts[0] + sum(p / 60.0 ** (i + 1) for i, p in enumerate(parts[1:]))
+    return -value if s[-1] in ('S', 'W') else value
+
+
+def xmp_gps_elements(root):
+    """Returns the rdf:Description element of an XMP tree that holds (or should hold) the exif:GPS properties"""
+    descriptions = root.findall('.//{%s}Description' % xmp_namespaces['rdf'])
+    for description in descriptions:
+        if description.get('{%s}GPSLatitude' % xmp_namespaces['exif']) is not None or \
+                description.find('{%s}GPSLatitude' % xmp_namespaces['exif']) is not None:
+            return description
+    return descriptions[0] if descriptions else None
+
+
+def read_xmp_geo(filename):
+    """Returns the (latitude, longitude) stored in an XMP sidecar file, or None if the file or the coordinates do
+    not exist"""
+    if not os.path.isfile(filename):
+        return None
+    description = xmp_gps_elements(ET.parse(filename).getroot())
+    if description is None:
+        return None
+    geo = []
+    for tag in ('GPSLatitude', 'GPSLongitude'):
+        key = '{%s}%s' % (xmp_namespaces['exif'], tag)
+        value = description.get(key)
+        if value is None:
+            value = description.findtext(key)
+        if not value:
+            return None
+        geo.append(parse_xmp_coordinate(value))
+    return tuple(geo)
+
+
+def write_xmp_geo(filename, lat, lng):
+    """Sets the coordinates in an XMP sidecar file, keeping any other metadata it already contains, or creates it.
+    The file is replaced atomically."""
+    rdf, exif = xmp_namespaces['rdf'], xmp_namespaces['exif']
+    namespaces = []
+    head = tail = None
+    if os.path.isfile(filename):
+        with open(filename, 'rb') as f:
+            data = f.read()
+        root = None
+        # ElementTree forgets the prefixes of the file, they are collected to write the same ones back
+        for event, item in ET.iterparse(BytesIO(data), events=('start', 'start-ns')):
+            if event == 'start-ns':
+                namespaces.append(item)
+            elif root is None:
+                root = item
+        begin, end = xpacket_begin_re.search(data), xpacket_end_re.search(data)
+        if begin is not None and end is not None:
+            head, tail = data[:begin.end()], data[end.start():]
+        description = xmp_gps_elements(root)
+    else:
+        root = ET.Element('{%s}xmpmeta' % xmp_namespaces['x'])
+        description = None
+    if description is None:
+        rdf_root = root.find('{%s}RDF' % rdf)
+        if rdf_root is None:
+            rdf_root = ET.SubElement(root, '{%s}RDF' % rdf)
+        description = ET.SubElement(rdf_root, '{%s}Description' % rdf, {'{%s}about' % rdf: ''})
+    for tag, value in (('GPSVersionID', '2.2.0.0'),
+                       ('GPSLatitude', xmp_coordinate(lat, 'NS')),
+                       ('GPSLongitude', xmp_coordinate(lng, 'EW'))):
+        key = '{%s}%s' % (exif, tag)
+        for child in description.findall(key):  # properties may also be written as elements
+            description.remove(child)
+        description.set(key, value)
+    with xmp_lock:
+        for prefix, uri in namespaces:
+            if prefix and not generated_prefix_re.match(prefix):
+                ET.register_namespace(prefix, uri)
+        if head is None:
+            data = ET.tostring(root, encoding='UTF-8')
+        else:
+            data = head + b'\n' + ET.tostring(root, encoding='utf-8') + b'\n' + tail
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(data)
+    os.rename(filename + '.tmp', filename)
+
+
+def physical_offset(path):
+    """Returns the offset of the first block of a file on its disk, using the FIEMAP ioctl, or None if the platform or
+    file system does not support it"""
+    if fcntl is None:
+        return None
+    buf = array('B', fiemap_header.pack(0, 2**64 - 1, 0, 0, 1, 0) + b'\0' * fiemap_extent.size)
+    try:
+        with open(path, 'rb') as f:
+            fcntl.ioctl(f.fileno(), fiemap_ioctl, buf)
+    except (IOError, OSError):
+        return None
+    if not fiemap_header.unpack_from(buf)[3]:  # no extent mapped yet, e.g. for an empty or inline file
+        return None
+    return fiemap_extent.unpack_from(buf, fiemap_header.size)[1]
+
+
+def disk_order(paths, extents=False):
+    """Sorts files by inode number, or with extents by physical location on disk where FIEMAP is available (and by
+    inode number otherwise), so that reading them sweeps spinning disks instead of seeking back and forth"""
+    keys = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:  # will be reported when the file is processed
+            keys.append(((float('inf'),), path))
+            continue
+        offset = physical_offset(path) if extents else None
+        keys.append(((st.st_dev, offset is None, offset or 0, st.st_ino), path))
+    keys.sort()
+    return [path for _, path in keys]
+
+
+def throughput_message(count, size, seconds):
+    """Formats the number of files and bytes processed per second for the end of a run"""
+    seconds = max(seconds, 1e-6)
+    return 'Went through %d files (%0.1f MB) in %0.2f s: %0.1f files/s, %0.1f MB/s' % \
+        (count, size / 2**20, seconds, count / seconds, size / 2**20 / seconds)
+
+
+def summary_message(summary):
+    """Formats a Counter of geotagging outcomes for the end of a run"""
+    return 'Processed %d files: %s' % (sum(summary.values()), ', '.join('%d %s' % (n, outcome)
+                                                                       for outcome, n in sorted(summary.items())))
+
+
+def format_duration(seconds):
+    """Formats a number of seconds as H:MM:SS"""
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+
+class ProgressReporter(object):
+    """Progress of a run: counts the outcomes of the TagResults it is given and the bytes of their files, and every
+    interval seconds logs the counts, files/s, MB/s and, if the expected number of files is known, the ETA.
+    If metrics_file is given, the same metrics are written to it in the Prometheus text format, for the textfile
+    collector of node_exporter. The file is replaced atomically, and its last progress timestamp only moves while
+    files are processed, so that stalled runs can be alerted on."""
+
+    def __init__(self, expected=None, interval=10.0, metrics_file=None):
+        self.expected = expected
+        self.interval = interval
+        self.metrics_file = metrics_file
+        self.summary = Counter()
+        self.count = 0
+        self.size = 0
+        self.start_time = self.last_progress = time.time()
+        self.next_report = self.start_time + interval if interval > 0 else float('inf')
+        if metrics_file is not None:
+            self.write_metrics(self.start_time)
+
+    def update(self, result=None):
+        """Counts a TagResult, and reports if the interval has elapsed. Without result, only reports if due."""
+        now = time.time()
+        if result is not None:
+            self.summary[result.outcome] += 1
+            self.count += 1
+            self.last_progress = now
+            try:
+                self.size += os.path.getsize(result.path)
+            except OSError:  # deleted in the meantime
+                pass
+        if now >= self.next_report:
+            self.report(now)
+            self.next_report = now + self.interval
+
+    def eta(self, now):
+        """Returns the estimated number of seconds until all the expected files are processed, or None"""
+        if self.expected is None or not self.count:
+            return None
+        return max(self.expected - self.count, 0) * (now - self.start_time) / self.count
+
+    def message(self, now):
+        """Formats the progress for the log"""
+        seconds = max(now - self.start_time, 1e-6)
+        eta = self.eta(now)
+        return 'Progress: %d%s files, %0.1f files/s, %0.1f MB/s%s - %s' % \
+            (self.count, '/%d' % self.expected if self.expected is not None else '', self.count / seconds,
+             self.size / 2**20 / seconds, ', ETA %s' % format_duration(eta) if eta is not None else '',
+             ', '.join('%d %s' % (self.summary[outcome], outcome) for outcome in tag_outcomes
+                       if self.summary[outcome]) or 'no files yet')
+
+    def report(self, now=None, finished=False):
+        """Logs the progress, and writes the metrics file if there is one"""
+        now = time.time() if now is None else now
+        logger.info(self.message(now))
+        if self.metrics_file is not None:
+            self.write_metrics(now, finished)
+
+    def write_metrics(self, now, finished=False):
+        """Replaces the metrics file with the current metrics"""
+        seconds = max(now - self.start_time, 1e-6)
+        eta = self.eta(now)
+        metrics = [('files_total', 'counter', 'Files processed, by outcome',
+                    [('{outcome="%s"}' % outcome, self.summary[outcome]) for outcome in tag_outcomes]),
+                   ('bytes_total', 'counter', 'Bytes of the files processed', [('', self.size)]),
+                   ('files_per_second', 'gauge', 'Files processed per second since the start of the run',
+                    [('', self.count / seconds)]),
+                   ('bytes_per_second', 'gauge', 'Bytes processed per second since the start of the run',
+                    [('', self.size / seconds)]),
+                   ('start_time_seconds', 'gauge', 'Unix time at which the run started', [('', self.start_time)]),
+                   ('last_progress_time_seconds', 'gauge', 'Unix time at which the last file was processed',
+                    [('', self.last_progress)]),
+                   ('finished', 'gauge', 'Whether the run is over', [('', int(finished))])]
+        if self.expected is not None:
+            metrics.append(('files_expected', 'gauge', 'Files to process in this run', [('', self.expected)]))
+        if eta is not None:
+            metrics.append(('eta_seconds', 'gauge', 'Estimated time until all the files are processed',
+                            [('', 0 if finished else eta)]))
+        lines = []
+        for name, metric_type, description, samples in metrics:
+            lines.append('# HELP pybatchgeotag_%s %s' % (name, description))
+            lines.append('# TYPE pybatchgeotag_%s %s' % (name, metric_type))
+            lines.extend('pybatchgeotag_%s%s %s' % (name, labels, repr(value) if isinstance(value, float) else value)
+                         for labels, value in samples)
+        # the collector could otherwise read a partly written file
+        tmp_path = '%s.%d.tmp' % (self.metrics_file, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.rename(tmp_path, self.metrics_file)
+        except (IOError, OSError):
+            logger.error('Could not write metrics to %s: %s' % (self.metrics_file, sys.exc_info()[1]))
+
+
+def is_jpeg(filename):
+    return os.path.splitext(filename)[1][1:] in jpeg_extensions
+
+
+def inotify_jpegs(folder, recursive=False, interval=2.0):
+    """See wait_for_jpegs. Relies on inotify, where a file is complete once closed after writing or moved in.
+    The watches are set up immediately, so that OSError is raised here if inotify cannot be used."""
+    inotify = INotify()
+    watch_flags = inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO | inotify_flags.CREATE
+    folders = {}
+    folders[inotify.add_watch(folder, watch_flags)] = folder
+    if recursive:
+        for root, subfolders, files in os.walk(folder):
+            for subfolder in subfolders:
+                path = os.path.join(root, subfolder)
+                folders[inotify.add_watch(path, watch_flags)] = path
+
+    def events():
+        while True:
+            ready = []
+            for event in inotify.read(timeout=int(interval * 1000)):
+                if event.wd not in folders:
+                    continue
+                path = os.path.join(folders[event.wd], event.name)
+                if event.mask & inotify_flags.ISDIR:
+                    if recursive and event.mask & (inotify_flags.CREATE | inotify_flags.MOVED_TO):
+                        folders[inotify.add_watch(path, watch_flags)] = path
+                elif event.mask & (inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO) and is_jpeg(path):
+                    ready.append(path)
+            yield ready
+    return events()
+
+
+def poll_jpegs(folder, recursive=False, interval=2.0):
+    """See wait_for_jpegs. Scans the folder periodically, where a file is complete once its size and modification
+    time did not change between two scans."""
+    last_stat = {}
+    reported = {}
+    for img in list_jpegs(folder, recursive):  # files already there are not new
+        st = os.stat(img)
+        last_stat[img] = reported[img] = (st.st_size, st.st_mtime)
+    while True:
+        time.sleep(interval)
+        ready = []
+        for img in list_jpegs(folder, recursive):
+            try:
+                st = os.stat(img)
+            except OSError:  # deleted in the meantime
+                continue
+            stat = (st.st_size, st.st_mtime)
+            if stat == last_stat.get(img) and stat != reported.get(img):
+                ready.append(img)
+                reported[img] = stat
+            last_stat[img] = stat
+        yield ready
+
+
+def wait_for_jpegs(folder, recursive=False, interval=2.0):
+    """Generator yielding, about every interval seconds, the list of JPEG files of a folder that were completely
+    written since the previous iteration. Files already present when it starts are ignored.
+    Uses inotify if the inotify_simple package is installed, and polls the folder otherwise."""
+    if INotify is not None:
+        try:
+            return inotify_jpegs(folder, recursive, interval)
+        except OSError:  # e.g. not on Linux, or too many watches
+            logger.debug('Could not use inotify, polling folder %s instead' % folder)
+    return poll_jpegs(folder, recursive, interval)
+
+
+def memory_budget(args):
+    """Returns the MemoryBudget set on the command line, or None if there is no limit"""
+    return MemoryBudget(args.max_memory * 2**20) if args.max_memory else None
+
+
+def load_track(args, local_tz, light=False):
+    """Loads the track of the coordinates files given on the command line, through the track cache unless disabled.
+    With light, small files are loaded into an ArrayTrack instead, which saves importing pandas"""
+    if light and sum(os.path.getsize(fn) for fn in args.coordinates) <= array_track_max_size:
+        try:
+            return ArrayTrack.from_csv(args.coordinates, args.no_header, local_tz, args.resampling_frequency)
+        except ValueError:
+            logger.debug('Could not load coordinates without pandas (%s)' % sys.exc_info()[1])
+    if args.no_cache:
+        return Track.from_csv(args.coordinates, args.no_header, local_tz, args.resampling_frequency)
+    cache = TrackCache(args.cache_dir, args.cache_size * 2**20)
+    return cache.load(args.coordinates, args.no_header, local_tz, args.resampling_frequency)
+
+
+def watch(args, cam_tz, local_tz):
+    """Runs watch mode: loads the track once, then geotags JPEG files as they appear in the folder, appending to the
+    track the locations added to the coordinates files in the meantime. Runs until interrupted."""
+    def reload_track():
+        # new rows are read from the offsets the files were loaded up to, which are only known if the files did not
+        # change during the load and end with a complete line: otherwise rows appended meanwhile would be read twice
+        for attempt in range(watch_load_attempts):
+            offsets = coordinates_offsets(args.coordinates)
+            track = load_track(args, local_tz)
+            if offsets is not None and coordinates_offsets(args.coordinates) == offsets:
+                break
+            time.sleep(watch_load_delay)
+        else:
+            logger.warning('Coordinates file(s) kept changing while loaded, locations appended meanwhile may be '
+                           'duplicated or missed')
+            offsets = dict((fn, os.path.getsize(fn)) for fn in args.coordinates)
+        logger.info('Datetime range of resampled coordinates file: %s to %s' %
+                    (track.dt_min.strftime('%Y-%m-%d %H:%M:%S%z'), track.dt_max.strftime('%Y-%m-%d %H:%M:%S%z')))
+        return track, offsets
+
+    try:
+        track, offsets = reload_track()
+    except:
+        logger.error('Could not open/parse coordinates file. '
+                     'Are you sure it is a CSV with 3 columns: datetime (str), latitude (float), longitude (float)?')
+        logger.error('Message: %s' % sys.exc_info()[1])
+        return
+    geotagger = GeoTagger(track, cam_tz, local_tz, args.overwrite, args.sidecar, args.verify)
+    budget = memory_budget(args)
+
+    progress = ProgressReporter(None, args.progress, args.metrics_file)
+    # (size, mtime) of the files we geotagged, so that our own writes are not picked up again. Their events come
+    # within one or two batches, so the oldest entries can be forgotten
+    processed = OrderedDict()
+    # datetime of the files after the end of the track, retried once the locations appended to it reach them. Files
+    # before its start are not kept, appending locations never brings them into range
+    pending = OrderedDict()
+    new_jpegs = wait_for_jpegs(args.folder, args.recursive, args.poll_interval)
+    logger.info('Watching folder %s%s for new JPEG files' % (args.folder, ' recursively' if args.recursive else ''))
+    try:
+        for imgs in new_jpegs:
+            new_locations = []
+            reloaded = False
+            try:
+                for fn in args.coordinates:
+                    rows, offsets[fn] = read_coordinates_tail(fn, offsets[fn])
+                    new_locations.extend(rows)
+                if new_locations:
+                    dfnew = localize_coordinates(pd.DataFrame.from_records(new_locations,
+                                                                           columns=['dt', 'latitude', 'longitude']),
+                                                 local_tz)
+                    geotagger.track.extend(dfnew)
+                    logger.debug('Appended %d locations to the track' % len(dfnew))
+            except ValueError:
+                logger.info('Coordinates file(s) changed (%s), reloading' % sys.exc_info()[1])
+                geotagger.track, offsets = reload_track()
+                reloaded = True
+            if (new_locations or reloaded) and pending:
+                ready = [img for img, dt in pending.items() if dt <= geotagger.track.dt_max]
+                for img in ready:
+                    del pending[img]
+                imgs = ready + imgs
+
+            new_imgs = []
+            for img in imgs:
+                if args.shard is not None and not in_shard(img, args.folder, args.shard):
+                    continue
+                try:
+                    st = os.stat(img)
+                except OSError:  # deleted in the meantime
+                    continue
+                if processed.get(img) != (st.st_size, st.st_mtime):
+                    new_imgs.append(img)
+            progress.update()
+            for result in geotagger.tag_paths(new_imgs, args.threads, budget, args.prefetch):
+                progress.update(result)
+                if result.outcome == 'tagged':
+                    st = os.stat(result.path)
+                    processed.pop(result.path, None)
+                    processed[result.path] = (st.st_size, st.st_mtime)
+                    if len(processed) > watch_max_remembered:
+                        processed.popitem(last=False)
+                elif result.outcome == 'out of range' and result.datetime > geotagger.track.dt_max:
+                    pending.pop(result.path, None)
+                    pending[result.path] = result.datetime
+                    if len(pending) > watch_max_remembered:
+                        logger.warning('Too many pictures after the end of the track, no longer retrying %s' %
+                                       pending.popitem(last=False)[0])
+    except KeyboardInterrupt:
+        pass
+    if args.metrics_file is not None:
+        progress.write_metrics(time.time(), finished=True)
+    logger.info(summary_message(progress.summary))
+    logger.info(geotagger.group_message())
+
+
+def serve(args, cam_tz, local_tz):
+    """Runs serve mode: loads the track once, then answers HTTP requests until interrupted"""
+    try:
+        track = load_track(args, local_tz)
+    except:
+        logger.error('Could not open/parse coordinates file. '
+                     'Are you sure it is a CSV with 3 columns: datetime (str), latitude (float), longitude (float)?')
+        logger.error('Message: %s' % sys.exc_info()[1])
+        return
+    server = GeoTagServer((args.host, args.port), GeoTagger(track, cam_tz, local_tz, args.overwrite),
+                          memory_budget(args))
+    logger.info('Serving coordinates from %s to %s on http://%s:%d/' %
+                (track.dt_min.strftime('%Y-%m-%d %H:%M:%S%z'), track.dt_max.strftime('%Y-%m-%d %H:%M:%S%z'),
+                 args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+class GeoTagRequestHandler(BaseHTTPRequestHandler):
+    """Handles the requests of serve mode, using the GeoTagger of the server:
+
+    GET /track: JSON object with the number of resampled locations, and the first and last time stamps of the track
+    POST /locate: JSON object {"timestamps": [...]} of camera time stamps, answered with {"locations": [...]} where
+        each location is a [latitude, longitude] pair, or null if the time stamp is invalid or out of range
+    POST /geotag: JPEG image, answered with the geotagged image. The outcome and coordinates are given in the
+        X-Geotag-Outcome, X-Geotag-Latitude and X-Geotag-Longitude headers
+    """
+
+    def send_body(self, status, content_type, body, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, obj):
+        self.send_body(status, 'application/json', json.dumps(obj).encode('utf-8'))
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_GET(self):
+        if self.path != '/track':
+            return self.send_json(404, {'error': 'Unknown path %s' % self.path})
+        track = self.server.geotagger.track
+        self.send_json(200, {'locations': len(track),
+                             'start': track.dt_min.strftime('%Y-%m-%d %H:%M:%S'),
+                             'end': track.dt_max.strftime('%Y-%m-%d %H:%M:%S')})
+
+    def do_POST(self):
+        if self.path == '/locate':
+            try:
+                timestamps = json.loads(self.read_body().decode('utf-8'))['timestamps']
+            except (ValueError, KeyError, TypeError):
+                timestamps = None
+            if not isinstance(timestamps, list) or not all(isinstance(t, string_types) for t in timestamps):
+                return self.send_json(400, {'error': 'Expecting a JSON object {"timestamps": [...]} with a list of '
+                                                     'EXIF time stamps'})
+            locations = self.server.geotagger.locate(timestamps)
+            self.send_json(200, {'locations': [None if geo is None else [float(geo[0]), float(geo[1])]
+                                               for geo in locations]})
+        elif self.path == '/geotag':
+            # the request and the geotagged image are held until the answer is sent
+            cost = 2 * int(self.headers.get('Content-Length', 0))
+            budget = self.server.budget
+            if budget is not None:
+                budget.acquire(cost)
+            try:
+                self.geotag_body()
+            finally:
+                if budget is not None:
+                    budget.release(cost)
+        else:
+            self.send_json(404, {'error': 'Unknown path %s' % self.path})
+
+    def geotag_body(self):
+        result, jpeg = self.server.geotagger.tag_bytes(self.read_body(), 'request from %s' % self.client_address[0])
+        if result.outcome == 'error':
+            return self.send_json(400, {'error': 'Not a valid JPEG file'})
+        headers = [('X-Geotag-Outcome', result.outcome)]
+        if result.latitude is not None:
+            headers += [('X-Geotag-Latitude', '%0.7f' % result.latitude),
+                        ('X-Geotag-Longitude', '%0.7f' % result.longitude)]
+        self.send_body(200, 'image/jpeg', jpeg, headers)
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s' % (self.client_address[0], format % args))
+
+
+class GeoTagServer(ThreadingMixIn, HTTPServer):
+    """HTTP server answering geotagging requests with a preloaded GeoTagger, see GeoTagRequestHandler"""
+    daemon_threads = True
+
+    def __init__(self, address, geotagger, budget=None):
+        """budget is an optional MemoryBudget for the images being geotagged: requests wait while it is full"""
+        HTTPServer.__init__(self, address, GeoTagRequestHandler)
+        self.geotagger = geotagger
+        self.budget = budget
+
+
 def main(argv):
     arg_parser = ArgumentParser()
-    arg_parser.add_argument('mode', choices=('convert', 'geotag'),
+    arg_parser.add_argument('mode', choices=('convert', 'geotag', 'watch', 'serve', 'merge-results', 'inventory',
+                                             'verify'),
                             help=('"convert mode": creates a clean locations.csv file from a Google LocationHistory.json'
                                   'file. Geotagging arguments will be ignored. "geotag" mode: uses the coordinates file'
                                   ' passed as argument to geotag all the JPEG pictures in the target folder. Conversion'
-                                  ' arguments will be ignored.'))
+                                  ' arguments will be ignored. "watch" mode: like geotag mode, but keeps running and'
+                                  ' geotags new JPEG pictures as they are written to the target folder. "serve" mode:'
+                                  ' answers geotagging requests over HTTP using the coordinates file. "merge-results"'
+                                  ' mode: summarises report files, and combines them into one if --report is given.'
+                                  ' "inventory" mode: writes the path, capture time, camera, coordinates and dimensions'
+                                  ' of all the JPEG pictures in the target folder to the report file, without modifying'
+                                  ' them. "verify" mode: checks that the image data of the pictures geotagged with'
+                                  ' --verify is unchanged since, using the hashes recorded in their report files.'))
     arg_parser.add_argument('-l', '--location-history',
-                            help='(convert mode) Google location history file (usually LocationHistory.json)')
+                            help='(convert mode) Google location history file (usually LocationHistory.json), '
+                                 'or GPS logger track (.gpx, .nmea)')
     arg_parser.add_argument('-s', '--start-date', help='(convert mode) Start date (inclusive) for conversion, format YYYY-MM-DD')
     arg_parser.add_argument('-e', '--end-date', help='(convert mode) End date (inclusive) for conversion, format YYYY-MM-DD')
     arg_parser.add_argument('-a', '--accuracy', type=int, default=100,
                             help='(convert mode) Minimum accuracy of a location for it to be considered valid (default 100 metres)')
-    arg_parser.add_argument('-c', '--coordinates', help='(geotag mode) Coordinates file (datetime, latitude, longitude)')
+    arg_parser.add_argument('--simplify', type=float, metavar='METRES',
+                            help='(convert mode) Simplify the track, so that the positions geotag mode finds with '
+                                 'the same resampling frequency (-rs) stay within this many metres of the ones it '
+                                 'finds without simplification (e.g. 10). Locations are averaged over time bins, and '
+                                 'stationary periods are collapsed, which makes the coordinates file much smaller '
+                                 'and faster to load (default: no simplification)')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+                            help='(convert/inventory mode) Number of processes used to parse a location history file, '
+                                 'or to read pictures (default: number of CPUs)')
+    arg_parser.add_argument('-c', '--coordinates', nargs='+',
+                            help='(geotag mode) Coordinates file(s) (datetime, latitude, longitude[, accuracy]). '
+                                 'Several files sorted by time can be given, they will be merged')
     arg_parser.add_argument('-n', '--no-header', action='store_true', default=False,
                             help='(geotag mode) Coordinates file has no header line (default false)')
-    arg_parser.add_argument('-f', '--folder', help='(geotag mode) Folder where images are located (images will be overwritten!)')
+    arg_parser.add_argument('-f', '--folder', help='(geotag/inventory mode) Folder where images are located (images will be overwritten in geotag mode!)')
     arg_parser.add_argument('-tz', '--timezone',
                             help='(geotag mode) Time zone (e.g., "UTC", or "Europe/Zurich") of the camera. It will be converted to your local time zone prior to geotagging')
     arg_parser.add_argument('-o', '--overwrite', action='store_true', default=False,
                             help='(geotag mode) Overwrite geodata for images that already have coordinates in EXIF (default false)')
+    arg_parser.add_argument('--sidecar', action='store_true', default=False,
+                            help='(geotag/watch mode) Write geodata to an XMP sidecar file next to each image (same '
+                                 'name, .xmp extension) instead of modifying the image (default false)')
+    arg_parser.add_argument('--report',
+                            help='(geotag/merge-results mode) Write the outcome and coordinates of each image to this '
+                                 'CSV file. (inventory mode) File the inventory is written to, in Parquet format if '
+                                 'its name ends with .parquet (requires pyarrow), in CSV otherwise (default '
+                                 'inventory.csv)')
+    arg_parser.add_argument('--places',
+                            help='(geotag mode) GeoNames gazetteer file (e.g. cities1000.txt) used to add the nearest '
+                                 'place of each image to the report. Requires scipy')
+    arg_parser.add_argument('--shard', type=parse_shard,
+                            help='(geotag/watch/inventory mode) Only process shard i out of n of the images, given '
+                                 'as i/n, so that several machines can share a folder. The report is written to '
+                                 'geotag-shard-i-of-n.csv (inventory-shard-i-of-n.csv in inventory mode) unless '
+                                 '--report is given')
+    arg_parser.add_argument('--verify', action='store_true', default=False,
+                            help='(geotag/watch mode) Hash the image data of each picture before rewriting it, '
+                                 'leave it unchanged if it differs from the file\'s (e.g. data after the end of image '
+                                 'would be lost), and check that the written file has the same: pictures that do not '
+                                 'are errors. The hash is recorded in the report, so that verify mode can check the pictures again '
+                                 'later (default false)')
+    arg_parser.add_argument('--results', nargs='+',
+                            help='(merge-results/verify mode) Report files to merge (e.g. the ones of all shards), '
+                                 'or to verify')
     arg_parser.add_argument('-r', '--recursive', action='store_true', default=False,
-                            help='(geotag mode) Browse folder recursively (default false)')
+                            help='(geotag/inventory mode) Browse folder recursively (default false)')
     arg_parser.add_argument('-rs', '--resampling_frequency', type=int, default=60,
-                            help='(geotag mode) Resampling frequency of the coordinates time series, in seconds (default 60)')
+                            help='(convert/geotag mode) Resampling frequency of the coordinates time series, in seconds (default 60)')
+    arg_parser.add_argument('--threads', type=int, default=1,
+                            help='(geotag/watch mode) Number of pictures geotagged at once (default 1)')
+    arg_parser.add_argument('--prefetch', type=int, default=0, metavar='FILES',
+                            help='(geotag/watch/inventory mode) Number of files whose metadata is read ahead of the '
+                                 'one being processed, by %d threads, which hides the latency of network or spinning '
+                                 'disks (e.g. 16, default 0: each file is read when it is processed)' % prefetch_threads)
+    arg_parser.add_argument('--disk-order', choices=('inode', 'extent'),
+                            help='(geotag mode) Process the pictures by inode number, or by physical location on '
+                                 'disk (extent, Linux only, by inode number elsewhere), to limit seeks on spinning '
+                                 'disks (default: scan order)')
+    arg_parser.add_argument('--max-memory', type=int,
+                            help='(geotag/watch/serve mode) Memory budget in MB for the pictures being geotagged at '
+                                 'once. New pictures are only picked up, and requests only read, while they fit into '
+                                 'it (default no limit)')
+    arg_parser.add_argument('--cache-dir', default=default_cache_dir(),
+                            help='(geotag/watch/serve mode) Directory where loaded coordinates are cached, so that '
+                                 'the same files load much faster the next time (default %(default)s)')
+    arg_parser.add_argument('--cache-size', type=int, default=track_cache_size // 2**20,
+                            help='(geotag/watch/serve mode) Maximum size of the cache in MB, the least recently used '
+                                 'entries are removed beyond it (default %(default)s)')
+    arg_parser.add_argument('--no-cache', action='store_true',
+                            help='(geotag/watch/serve mode) Do not read or write the cache of coordinates')
+    arg_parser.add_argument('-p', '--poll-interval', type=float, default=2.0,
+                            help='(watch mode) Interval between checks for new pictures and coordinates, in seconds '
+                                 '(default 2)')
+    arg_parser.add_argument('--host', default='127.0.0.1',
+                            help='(serve mode) Address to listen on (default 127.0.0.1)')
+    arg_parser.add_argument('--port', type=int, default=8080,
+                            help='(serve mode) Port to listen on (default 8080)')
+    arg_parser.add_argument('--progress', type=float, default=10.0, metavar='SECONDS',
+                            help='(geotag/watch mode) Interval between progress reports (files/s, MB/s, ETA and '
+                                 'number of files per outcome), 0 to turn them off (default 10)')
+    arg_parser.add_argument('--metrics-file',
+                            help='(geotag/watch mode) Also write the progress to this file in the Prometheus text '
+                                 'format, replacing it at each report, e.g. for the textfile collector of '
+                                 'node_exporter (file name ending with .prom)')
+    arg_parser.add_argument('--log-files', action='store_true', default=False,
+                            help='(geotag/watch mode) Log the outcome of each picture (default false)')
     arg_parser.add_argument('-v', '--verbosity', type=int, default=2, choices=range(1, 4),
                             help='Verbosity level (1-3, default 2)')
     argv = argv[1:]
@@ -74,47 +2359,58 @@ def main(argv):
     logger = logging.getLogger()
     logger.addHandler(sh)
     logger.setLevel(log_level)
+    file_logger.setLevel(log_level if args.log_files else logging.WARNING)
 
     if args.mode == 'convert':
         if args.location_history is None:
             logger.error('Required argument: location-history (-l)')
             return
         try:
-            dfraw = pd.read_json(args.location_history)
-            sraw = dfraw['locations']  # Series
-            logger.debug('Read %s locations from %s' % (len(sraw), args.location_history))
-            df = pd.DataFrame()
-            df['ts'] = sraw.apply(lambda x: int(x['timestampMs']))
-            df['dt'] = df['ts'].apply(lambda x: datetime.datetime.fromtimestamp(x / 1000))  # produces naive timestamps in local timezone
-            df['longitude'] = sraw.apply(lambda x: x['longitudeE7'] / 10000000.0)
-            df['latitude'] = sraw.apply(lambda x: x['latitudeE7'] / 10000000.0)
-            df['accuracy'] = sraw.apply(lambda x: x['accuracy'])
-            df.sort_values(by='ts', inplace=True)
-            df.set_index('dt', inplace=True)
-        except:
-            logger.error('Could not open/parse location history file.')
-            logger.error('Message: %s' % sys.exc_info()[1])
+            start_date = datetime.datetime.strptime(args.start_date, '%Y-%m-%d') if args.start_date else None
+            end_date = (datetime.datetime.strptime(args.end_date, '%Y-%m-%d') + datetime.timedelta(days=1)
+                        if args.end_date else None)
+        except ValueError:
+            logger.error('Could not parse start or end date. Is the date in YYYY-MM-DD format?')
             return
-        # filtering DataFrame based on start date, end date, location accuracy
-        if args.start_date:
-            try:
-                print(args.start_date)
-                df = df[df.index >= datetime.datetime.strptime(args.start_date, '%Y-%m-%d')]
-                logger.debug('Filtered to %s locations from %s or later' % (len(df), args.start_date))
-            except:
-                logger.error('Could not filter location history file based on start date. Is the date in YYYY-MM-DD format?')
-                logger.error('Message: %s' % sys.exc_info()[1])
-                return
-        if args.end_date:
+        track_format = os.path.splitext(args.location_history)[1].lower()
+        if track_format in track_readers:
+            # GPS logger tracks are streamed straight to the coordinates file. They carry no accuracy in metres,
+            # so only the date filters apply
+            if os.path.isfile('locations.csv'):
+                cont = input('WARNING: the file locations.csv exists. Do you want to overwrite it? [N/y] ')
+                if cont not in ['y', 'Y', 'yes', 'YES']:
+                    return
             try:
-                df = df[df.index <= datetime.datetime.strptime(args.end_date, '%Y-%m-%d') + datetime.timedelta(days=1)]
-                logger.debug('Filtered to %s locations from %s or earlier' % (len(df), args.end_date))
+                count, dt_first, dt_last = export_track(track_readers[track_format](args.location_history),
+                                                        'locations.csv', get_localzone(), start_date, end_date,
+                                                        args.simplify, args.resampling_frequency)
             except:
-                logger.error('Could not filter location history file based on end date. Is the date in YYYY-MM-DD format?')
+                logger.error('Could not convert track file %s to locations.csv' % args.location_history)
                 logger.error('Message: %s' % sys.exc_info()[1])
                 return
-        df = df[df.accuracy <= args.accuracy]
-        logger.debug('Filtered to %s locations with minimum accuracy %s metres' % (len(df), args.accuracy))
+            logger.info('Exported %d locations to locations.csv' % count)
+            if count > 0:
+                logger.info('Range of the exported time series of coordinates: %s to %s' %
+                            (dt_first.strftime('%Y-%m-%d %H:%M:%S%z'), dt_last.strftime('%Y-%m-%d %H:%M:%S%z')))
+            return
+        try:
+            df = read_location_history(args.location_history, get_localzone(), start_date, end_date, args.accuracy,
+                                       args.jobs)
+        except:
+            logger.error('Could not open/parse location history file.')
+            logger.error('Message: %s' % sys.exc_info()[1])
+            return
+        logger.debug('Kept %s locations with minimum accuracy %s metres between the start and end dates' %
+                     (len(df), args.accuracy))
+        if args.simplify is not None and len(df) > 0:
+            seconds, latitudes, longitudes = simplify_track(df.ts.values / 1000.0, df.latitude.values,
+                                                            df.longitude.values, args.simplify,
+                                                            args.resampling_frequency)
+            logger.info('Simplified the track from %d to %d locations' % (len(df), len(seconds)))
+            df = pd.DataFrame({'latitude': latitudes, 'longitude': longitudes},
+                              index=pd.to_datetime(seconds, unit='s').tz_localize('UTC').tz_convert(get_localzone())
+                              .tz_localize(None))
+            df.index.name = 'dt'
         try:
             if os.path.isfile('locations.csv'):
                 cont = input('WARNING: the file locations.csv exists. Do you want to overwrite it? [N/y] ')
@@ -131,7 +2427,57 @@ def main(argv):
                         (df.index.min().strftime('%Y-%m-%d %H:%M:%S%z'), df.index.max().strftime('%Y-%m-%d %H:%M:%S%z')))
         return
 
-    if (args.coordinates is None) or (args.folder is None):
+    if args.mode == 'merge-results':
+        if args.results is None:
+            logger.error('Required argument: results (--results)')
+            return
+        try:
+            summary = merge_reports(args.results, args.report)
+        except:
+            logger.error('Could not merge report files')
+            logger.error('Message: %s' % sys.exc_info()[1])
+            return
+        if args.report is not None:
+            logger.info('Wrote merged report to %s' % args.report)
+        logger.info(summary_message(summary))
+        return
+
+    if args.mode == 'verify':
+        if args.results is None:
+            logger.error('Required argument: results (--results)')
+            return
+        try:
+            summary = verify_reports(args.results)
+        except:
+            logger.error('Could not verify report files')
+            logger.error('Message: %s' % sys.exc_info()[1])
+            return 1
+        logger.info(summary_message(summary))
+        return 1 if summary['changed'] or summary['unreadable'] else None
+
+    if args.mode == 'inventory':
+        if args.folder is None:
+            logger.error('Required argument: folder (-f)')
+            return
+        if args.report is None:
+            args.report = 'inventory.csv' if args.shard is None else 'inventory-shard-%d-of-%d.csv' % args.shard
+        start_time = time.time()
+        try:
+            count, size = write_inventory(args.report, iter_jpegs(args.folder, args.recursive, args.shard), args.jobs,
+                                          prefetch=args.prefetch)
+        except:
+            logger.error('Could not write the inventory to %s' % args.report)
+            logger.error('Message: %s' % sys.exc_info()[1])
+            return
+        logger.info('Wrote the inventory of %d files to %s' % (count, args.report))
+        logger.info(throughput_message(count, size, time.time() - start_time))
+        return
+
+    if args.mode == 'serve':
+        if args.coordinates is None:
+            logger.error('Required argument: coordinates (-c)')
+            return
+    elif (args.coordinates is None) or (args.folder is None):
         logger.error('Required arguments: coordinates (-c) folder (-f)')
         return
 
@@ -145,7 +2491,31 @@ def main(argv):
         cam_tz = get_localzone()
     local_tz = get_localzone()
 
-    imgs = list_jpegs(args.folder, args.recursive)
+    if args.places is not None:
+        if args.report is None:
+            logger.error('Argument places (--places) requires a report file (--report)')
+            return
+        try:
+            places = PlaceIndex.load(args.places)
+        except:
+            logger.error('Could not load the gazetteer file %s' % args.places)
+            logger.error('Message: %s' % sys.exc_info()[1])
+            return
+    else:
+        places = None
+
+    if args.mode == 'serve':
+        return serve(args, cam_tz, local_tz)
+    if args.mode == 'watch':
+        if not args.sidecar:
+            logger.warning('EXIF information of new JPEG image files in the target folder(s) will be overwritten')
+        return watch(args, cam_tz, local_tz)
+
+    imgs = list_jpegs(args.folder, args.recursive, args.shard)
+    if args.shard is not None:
+        logger.info('Processing shard %d/%d of folder %s' % (args.shard + (args.folder,)))
+        if args.report is None:
+            args.report = 'geotag-shard-%d-of-%d.csv' % args.shard
 
     if not imgs:  # no image files found during scan
         logging.info('No JPEG image file found during %sscan of folder %s' %
@@ -154,106 +2524,45 @@ def main(argv):
     warn_msg = '''WARNING: There are %s JPEG image files in the target folder(s).
          If present, their EXIF information will be overwritten, which may result in irremediable loss of data.
          Do you want to continue? [N/y] ''' % len(imgs)
-    cont = input(warn_msg)
-    if cont not in ['y', 'Y', 'yes', 'YES']:
-        return
+    if not args.sidecar:  # images are only read in sidecar mode
+        cont = input(warn_msg)
+        if cont not in ['y', 'Y', 'yes', 'YES']:
+            return
 
     try:
-        dfloc = pd.read_csv(args.coordinates,
-                            names=['dt', 'latitude', 'longitude'],
-                            parse_dates=['dt'],
-                            skiprows=0 if args.no_header else 1,
-                            dtype={'latitude': np.float64, 'longitude': np.float64})
+        track = load_track(args, local_tz, light=True)
     except:
         logger.error('Could not open/parse coordinates file. '
                      'Are you sure it is a CSV with 3 columns: datetime (str), latitude (float), longitude (float)?')
         logger.error('Message: %s' % sys.exc_info()[1])
         return
 
-    logging.debug('Opened coordinates file "%s", %d locations found' % (args.coordinates, len(dfloc)))
-
-    # localising timestamps to local time zone
-    dfloc.dt = dfloc.dt.apply(lambda x: pytz.utc.localize(x).astimezone(local_tz).replace(tzinfo=None))
-    dfloc.set_index('dt', inplace=True)
-    dfloc.sort_index(inplace=True)
-
-    # resampling time series by taking the mean of points falling within a time bin, and interpolating linearly.
-    # This is very fast only because we use linear interpolation.
-    len_ = len(dfloc)
-    dfloc = dfloc.resample('%dS' % args.resampling_frequency).mean().interpolate()
-    logger.debug('Resampled coordinates to %d-second frequency, went from %d positions to %d'
-                 % (args.resampling_frequency, len_, len(dfloc)))
-
-    dt_min = dfloc.index[0].to_pydatetime()
-    dt_max = dfloc.index[-1].to_pydatetime()
     logger.info('Datetime range of resampled coordinates file: %s to %s' %
-                (dt_min.strftime('%Y-%m-%d %H:%M:%S%z'), dt_max.strftime('%Y-%m-%d %H:%M:%S%z')))
-
-    for img in imgs:
-        logger.debug('Opening %s to read EXIF data' % img)
-        try:
-            jf = JpegFile.fromFile(img)
-        except:
-            logger.error('Could not open %s. This file does not appear to have a valid EXIF structure' % img)
-            continue
-        try:
-            exif = jf.get_exif().get_primary()
-        except:
-            logger.info('Could not read EXIF data from %s. Skipping file' % img)
-            continue
-        try:
-            img_dt = exif.ExtendedEXIF.DateTimeOriginal
-            logger.debug('Read DateTimeOriginal for %s: %s' % (img, img_dt))
-        except:
-            try:
-                img_dt = exif.ExtendedEXIF.DateTimeDigitized
-                logger.debug('Read DateTimeDigitized for %s: %s' % (img, img_dt))
-            except:
-                try:
-                    img_dt = exif.DateTime
-                    logger.debug('Read DateTime for %s: %s' % (img, img_dt))
-                except:
-                    logger.info('No datetime information found in EXIF for %s. Skipping file' % img)
-                    continue
-
-        for dtf in datetime_formats:
-            try:
-                img_dt = datetime.datetime.strptime(img_dt, dtf)
-                break
-            except ValueError:
-                pass
-        if not isinstance(img_dt, datetime.datetime):  # parsing failed:
-            logger.info('Could not parse valid datetime information from EXIF for %s. Skipping file' % img)
-            continue
-
-        # localising image to local timezone, since location timestamps are local
-        img_dt = cam_tz.localize(img_dt).astimezone(local_tz).replace(tzinfo=None)
-
-        if not (dt_min <= img_dt <= dt_max):
-            logger.info('Datetime information for %s (%s) is outside of target range. Skipping file' %
-                        (img, img_dt.strftime('%Y-%m-%d %H:%M:%S%z')))
-            continue
+                (track.dt_min.strftime('%Y-%m-%d %H:%M:%S%z'), track.dt_max.strftime('%Y-%m-%d %H:%M:%S%z')))
 
+    geotagger = GeoTagger(track, cam_tz, local_tz, args.overwrite, args.sidecar, args.verify)
+    start_time = time.time()
+    if args.disk_order is not None:
+        imgs = disk_order(imgs, args.disk_order == 'extent')
+        logger.debug('Sorted files by %s' % args.disk_order)
+    progress = ProgressReporter(len(imgs), args.progress, args.metrics_file)
+    results = []
+    for result in geotagger.tag_paths(imgs, args.threads, memory_budget(args), args.prefetch):
+        progress.update(result)
+        if args.report is not None:
+            results.append(result)
+    if args.metrics_file is not None:
+        progress.write_metrics(time.time(), finished=True)
+    if args.report is not None:
         try:
-            (lng, lat) = jf.get_geo()
-            has_geo = True
+            write_report(args.report, results, places)
+            logger.info('Wrote report to %s' % args.report)
         except:
-            has_geo = False
-
-        if has_geo and not args.overwrite:
-            logger.info('Found existing geodata for %s. Skipping file' % img)
-            continue
-
-        # DatetimeIndex.asof() returns last index in the past, so we need to add half a period to get the nearest one
-        idx = dfloc.index.asof(img_dt + datetime.timedelta(seconds=args.resampling_frequency//2))
-        if not isinstance(idx, pd.tslib.Timestamp) and np.isnan(idx):
-            logger.error('Could not interpolate time index for %s. Skipping file' % img)
-        lat_ = dfloc.latitude[idx]
-        lng_ = dfloc.longitude[idx]
-
-        logger.info('Setting geodata for %s to (%0.6f, %0.6f)' % (img, lat_, lng_))
-        jf.set_geo(lat_, lng_)
-        jf.writeFile(img)
+            logger.error('Could not write report to %s' % args.report)
+            logger.error('Message: %s' % sys.exc_info()[1])
+    logger.info(summary_message(progress.summary))
+    logger.info(throughput_message(progress.count, progress.size, time.time() - start_time))
+    logger.info(geotagger.group_message())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,92 @@
+"""Tests of pybatchgeotag, on pictures generated with the EXIF blobs of bench_pexif. Like pexif, they run on Python 2:
+
+python -m unittest test_pybatchgeotag
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import pytz
+
+from bench_pexif import exif_jpeg
+from pexif import JpegFile
+from pybatchgeotag import GeoTagger, Track, image_hash, list_jpegs
+
+
+class SidecarRerunTest(unittest.TestCase):
+    """Geotagging sidecar files a second time, with the same track, leaves them all unchanged"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        coordinates = os.path.join(self.folder, 'locations.csv')
+        with open(coordinates, 'w') as f:
+            f.write('dt,latitude,longitude\n')
+            for i in range(61):
+                f.write('2016-03-27 %02d:%02d:00,%0.4f,%0.4f\n' %
+                        (5 + i // 20, i % 20 * 3, 46.5 + 0.01 * i, 7.25 - 0.01 * i))
+        self.track = Track.from_csv([coordinates], local_tz=pytz.utc)
+        # pictures with and without GPS data in EXIF, which is not what their sidecar files are compared with
+        for i in range(10):
+            jf = JpegFile.fromString(exif_jpeg(e='<' if i % 2 else '>', gps=i % 3 == 0))
+            jf.exif.primary.ExtendedEXIF.DateTimeOriginal = '2016:03:27 %02d:%02d:00' % (5 + i // 4, i % 4 * 13)
+            jf.writeFile(os.path.join(self.folder, 'img%d.jpg' % i))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def tag(self):
+        geotagger = GeoTagger(self.track, pytz.utc, pytz.utc, overwrite=True, sidecar=True)
+        outcomes = [result.outcome for result in geotagger.tag_paths(list_jpegs(self.folder))]
+        return dict((outcome, outcomes.count(outcome)) for outcome in set(outcomes))
+
+    def test_rerun(self):
+        self.assertEqual(self.tag(), {'tagged': 10})
+        self.assertEqual(self.tag(), {'unchanged': 10})
+
+    def test_rerun_other_track(self):
+        self.tag()
+        self.track.dfres.latitude += 0.1
+        self.assertEqual(self.tag(), {'tagged': 10})
+
+
+class VerifyTest(unittest.TestCase):
+    """With verify, pictures whose image data pexif would not write back as it is are left unchanged"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        coordinates = os.path.join(self.folder, 'locations.csv')
+        with open(coordinates, 'w') as f:
+            f.write('dt,latitude,longitude\n2016-03-27 05:00:00,46.5,7.25\n2016-03-27 06:00:00,46.6,7.35\n')
+        self.track = Track.from_csv([coordinates], local_tz=pytz.utc)
+        jf = JpegFile.fromString(exif_jpeg())
+        jf.exif.primary.ExtendedEXIF.DateTimeOriginal = '2016:03:27 05:30:00'
+        self.picture = jf.writeString()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def tag(self, data):
+        path = os.path.join(self.folder, 'img.jpg')
+        with open(path, 'wb') as f:
+            f.write(data)
+        result = GeoTagger(self.track, pytz.utc, pytz.utc, verify=True).tag_path(path)
+        with open(path, 'rb') as f:
+            return result, f.read()
+
+    def test_rewritten(self):
+        result, written = self.tag(self.picture)
+        self.assertEqual(result.outcome, 'tagged')
+        self.assertEqual(result.image_hash, image_hash(os.path.join(self.folder, 'img.jpg')))
+        self.assertNotEqual(written, self.picture)
+
+    def test_trailer(self):
+        # e.g. the video of a Motion Photo, which pexif drops as it keeps the data up to the first end of image
+        data = self.picture + 'ftypmp42' + '\0' * 16384
+        result, written = self.tag(data)
+        self.assertEqual(result.outcome, 'error')
+        self.assertEqual(written, data)
+
+
+if __name__ == '__main__':
+    unittest.main()